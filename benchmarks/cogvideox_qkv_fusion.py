@@ -0,0 +1,68 @@
+"""
+Benchmark of the CogVideoX attention projections: separate to_q/to_k/to_v linear layers against
+the single to_qkv layer built by `fuse_qkv_projections`, on toy sized configs.
+
+    python benchmarks/cogvideox_qkv_fusion.py [--device cpu] [--dim 512] [--tokens 2048]
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+
+
+def timeit(fn, device, iters):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def fuse(to_q, to_k, to_v):
+    # same construction as fuse_qkv_projections
+    to_qkv = nn.Linear(to_q.in_features, to_q.out_features * 3, bias=to_q.bias is not None, device="meta")
+    to_qkv.weight = nn.Parameter(torch.cat([to_q.weight, to_k.weight, to_v.weight]), requires_grad=False)
+    if to_q.bias is not None:
+        to_qkv.bias = nn.Parameter(torch.cat([to_q.bias, to_k.bias, to_v.bias]), requires_grad=False)
+    return to_qkv
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1024, 2048, 4096])
+    parser.add_argument("--dim", type=int, nargs="+", default=[256, 512])
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    for dim in args.dim:
+        to_q, to_k, to_v = (nn.Linear(dim, dim, bias=True).to(device, dtype) for _ in range(3))
+        to_qkv = fuse(to_q, to_k, to_v)
+        for tokens in args.tokens:
+            x = torch.randn(args.batch, tokens, dim, device=device, dtype=dtype)
+
+            def separate():
+                return to_q(x), to_k(x), to_v(x)
+
+            def fused():
+                return to_qkv(x).split(dim, dim=-1)
+
+            diff = max((a - b).abs().max().item() for a, b in zip(separate(), fused()))
+            separate_ms = timeit(separate, device, args.iters)
+            fused_ms = timeit(fused, device, args.iters)
+            print(f"dim={dim:5d} tokens={tokens:6d}: separate {separate_ms:8.3f} ms, fused {fused_ms:8.3f} ms, "
+                  f"speedup {separate_ms / fused_ms:5.2f}x, max abs diff {diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Attribute access overhead on a compiled diffusion model: the TeaCache forwards read and write
+`teacache_state`, blocks and parameters on every step. Compares the plain module, the previous
+process-wide OptimizedModule `__getattribute__` patch and the `__dict__`-sharing proxy that
+Compile Model uses now. Nothing is compiled, only attribute access is measured.
+
+    python benchmarks/compiled_attribute_access.py [--iters 1000000]
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+
+
+class Model(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.img_in = nn.Linear(8, 8)
+        self.double_blocks = nn.ModuleList([nn.Linear(8, 8) for _ in range(4)])
+        self.teacache_state = {"accumulated_rel_l1_distance": 0}
+
+
+def patch_optimized_module(OptimizedModule):
+    # the process-wide patch Compile Model used to install
+    forwarded = ("__class__", "_modules", "state_dict", "load_state_dict", "parameters", "named_parameters",
+                 "buffers", "named_buffers", "children", "named_children", "modules", "named_modules")
+
+    def __getattribute__(self, name):
+        if name == "_orig_mod":
+            return object.__getattribute__(self, "_modules")[name]
+        if name in forwarded:
+            return getattr(object.__getattribute__(self, "_orig_mod"), name)
+        return object.__getattribute__(self, name)
+
+    def __delattr__(self, name):
+        return delattr(self._orig_mod, name)
+
+    OptimizedModule.__getattribute__ = __getattribute__
+    OptimizedModule.__delattr__ = __delattr__
+
+
+def compiled_module_proxy(module, compiled):
+    proxy_class = type(f"Compiled{type(module).__name__}", (type(module),), {
+        "__call__": lambda self, *args, **kwargs: compiled(*args, **kwargs),
+    })
+    proxy = object.__new__(proxy_class)
+    proxy.__dict__ = module.__dict__
+    return proxy
+
+
+def bench(model, iters):
+    def hot_path():
+        for _ in range(iters):
+            hasattr(model, "teacache_state")
+            model.teacache_state["accumulated_rel_l1_distance"] += 1
+            model.img_in
+            model.double_blocks
+    start = time.perf_counter()
+    hot_path()
+    return (time.perf_counter() - start) / iters * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iters", type=int, default=1000000)
+    args = parser.parse_args()
+
+    from torch._dynamo.eval_frame import OptimizedModule
+
+    plain = Model()
+    results = {"plain module": bench(plain, args.iters)}
+    results["proxy"] = bench(compiled_module_proxy(plain, torch.compile(plain)), args.iters)
+    results["OptimizedModule"] = bench(torch.compile(Model()), args.iters)
+    patch_optimized_module(OptimizedModule)
+    results["patched OptimizedModule"] = bench(torch.compile(Model()), args.iters)
+
+    for name, ns in results.items():
+        print(f"{name:>24}: {ns:8.1f} ns per hot-path iteration")
+
+
+if __name__ == "__main__":
+    main()
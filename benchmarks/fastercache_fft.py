@@ -0,0 +1,96 @@
+"""
+Benchmark of the FasterCache uncond reconstruction: the original complex `fft()` low/high
+frequency split against the cached-mask real FFT `FrequencyDelta`.
+
+    python benchmarks/fastercache_fft.py [--device cuda] [--frames 13] [--height 60] [--width 90]
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fastercache import FrequencyDelta
+
+
+def fft(tensor):
+    # original implementation previously used by the CogVideoX FasterCache path
+    tensor_fft = torch.fft.fft2(tensor)
+    tensor_fft_shifted = torch.fft.fftshift(tensor_fft)
+    B, C, H, W = tensor.size()
+    radius = min(H, W) // 5
+
+    Y, X = torch.meshgrid(torch.arange(H), torch.arange(W), indexing='ij')
+    center_x, center_y = W // 2, H // 2
+    mask = (X - center_x) ** 2 + (Y - center_y) ** 2 <= radius ** 2
+    low_freq_mask = mask.unsqueeze(0).unsqueeze(0).to(tensor.device)
+    high_freq_mask = ~low_freq_mask
+
+    low_freq_fft = tensor_fft_shifted * low_freq_mask
+    high_freq_fft = tensor_fft_shifted * high_freq_mask
+
+    return low_freq_fft, high_freq_fft
+
+
+def reference_update(cond, uncond):
+    lf_c, hf_c = fft(cond.float())
+    lf_uc, hf_uc = fft(uncond.float())
+    return lf_uc - lf_c, hf_uc - hf_c
+
+
+def reference_reconstruct(cond, delta_lf, delta_hf):
+    lf_c, hf_c = fft(cond.float())
+    combined_fft = torch.fft.ifftshift(delta_lf + lf_c + delta_hf + hf_c)
+    return torch.fft.ifft2(combined_fft).real.to(cond.dtype)
+
+
+def timeit(fn, device, iters):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--frames", type=int, default=13)
+    parser.add_argument("--channels", type=int, default=16)
+    parser.add_argument("--height", type=int, default=60)
+    parser.add_argument("--width", type=int, default=90)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    shape = (args.frames, args.channels, args.height, args.width)
+    cond = torch.randn(shape, device=device)
+    uncond = cond + 0.1 * torch.randn(shape, device=device)
+
+    delta_lf, delta_hf = reference_update(cond, uncond)
+    freq_delta = FrequencyDelta(cond, uncond)
+
+    # check both implementations agree, including the band boosting
+    expected = reference_reconstruct(cond, delta_lf * 1.1, delta_hf)
+    actual = freq_delta.reconstruct(cond, boost_lf=True)
+    freq_delta.lf_scale = 1.0
+    print(f"shape={shape} device={device} max abs diff={(expected - actual).abs().max().item():.3e}")
+
+    results = {
+        "update (fft)": timeit(lambda: reference_update(cond, uncond), device, args.iters),
+        "update (rfft)": timeit(lambda: FrequencyDelta(cond, uncond), device, args.iters),
+        "reconstruct (fft)": timeit(lambda: reference_reconstruct(cond, delta_lf * 1.1, delta_hf * 1.1), device, args.iters),
+        "reconstruct (rfft)": timeit(lambda: freq_delta.reconstruct(cond, boost_lf=True, boost_hf=True), device, args.iters),
+    }
+    for name, ms in results.items():
+        print(f"{name:>20}: {ms:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
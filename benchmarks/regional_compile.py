@@ -0,0 +1,108 @@
+"""
+Compile time and steady-state step time of a toy transformer stack compiled as a whole model,
+block by block, and regionally (one shared compiled forward for all identical blocks, the
+`compile_scope="regional"` option of Compile Model). Runs on CPU.
+
+    python benchmarks/regional_compile.py [--depth 19] [--backend inductor]
+"""
+import argparse
+import copy
+import time
+import types
+
+import torch
+from torch import nn
+
+
+class Block(nn.Module):
+    def __init__(self, dim, heads):
+        super().__init__()
+        self.heads = heads
+        self.norm1 = nn.LayerNorm(dim, elementwise_affine=False, eps=1e-6)
+        self.qkv = nn.Linear(dim, dim * 3)
+        self.proj = nn.Linear(dim, dim)
+        self.norm2 = nn.LayerNorm(dim, elementwise_affine=False, eps=1e-6)
+        self.mlp = nn.Sequential(nn.Linear(dim, dim * 4), nn.GELU(approximate="tanh"), nn.Linear(dim * 4, dim))
+        self.modulation = nn.Linear(dim, dim * 4)
+
+    def forward(self, x, vec):
+        shift1, scale1, shift2, scale2 = self.modulation(vec)[:, None].chunk(4, dim=-1)
+        q, k, v = self.qkv(self.norm1(x) * (1 + scale1) + shift1).unflatten(-1, (3, self.heads, -1)).permute(2, 0, 3, 1, 4)
+        attn = nn.functional.scaled_dot_product_attention(q, k, v).transpose(1, 2).flatten(2)
+        x = x + self.proj(attn)
+        return x + self.mlp(self.norm2(x) * (1 + scale2) + shift2)
+
+
+class Stack(nn.Module):
+    def __init__(self, dim, heads, depth):
+        super().__init__()
+        self.blocks = nn.ModuleList([Block(dim, heads) for _ in range(depth)])
+
+    def forward(self, x, vec):
+        for block in self.blocks:
+            x = block(x, vec)
+        return x
+
+
+def compile_model(model, compile_fn):
+    return compile_fn(model)
+
+
+def compile_blocks(model, compile_fn):
+    for i, block in enumerate(model.blocks):
+        model.blocks[i] = compile_fn(block)
+    return model
+
+
+def compile_regional(model, compile_fn):
+    if hasattr(torch._dynamo.config, "inline_inbuilt_nn_modules"):
+        torch._dynamo.config.inline_inbuilt_nn_modules = True
+    forward = compile_fn(Block.forward)
+    for block in model.blocks:
+        block.forward = types.MethodType(forward, block)
+    return model
+
+
+def timeit(fn, iters):
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=int, default=19)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=256)
+    parser.add_argument("--backend", default="inductor", choices=["inductor", "aot_eager", "eager"])
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    reference = Stack(args.dim, args.heads, args.depth).eval()
+    x = torch.randn(1, args.tokens, args.dim)
+    vec = torch.randn(1, args.dim)
+    expected = reference(x, vec)
+
+    def compile_fn(target):
+        return torch.compile(target, backend=args.backend)
+
+    print(f"depth {args.depth}, dim {args.dim}, tokens {args.tokens}, backend {args.backend}")
+    eager_ms = timeit(lambda: reference(x, vec), args.iters)
+    print(f"{'eager':>8}: {'-':>10}   step {eager_ms:8.2f} ms")
+    for name, apply in (("model", compile_model), ("blocks", compile_blocks), ("regional", compile_regional)):
+        torch._dynamo.reset()
+        model = apply(copy.deepcopy(reference), compile_fn)
+        start = time.perf_counter()
+        output = model(x, vec)
+        compile_s = time.perf_counter() - start
+        step_ms = timeit(lambda: model(x, vec), args.iters)
+        max_diff = (output - expected).abs().max().item()
+        print(f"{name:>8}: compile {compile_s:6.2f} s   step {step_ms:8.2f} ms   max diff {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Per-step cost of the TeaCache skip test on skipped steps: the modulated input signal (img_norm1 and
+modulation over every image token) against the modulation vector signal used by
+`skip_signal="modulation"`, on FLUX-like shapes.
+
+    python benchmarks/teacache_skip_signal.py [--device cuda] [--tokens 4096] [--dim 3072]
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+
+
+def timeit(fn, device, iters):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def rel_l1(current, previous):
+    return (current - previous).abs().mean() / (previous.abs().mean() + 1e-8)
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1024, 4096])
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    img_norm1 = nn.LayerNorm(args.dim, elementwise_affine=False, eps=1e-6).to(device, dtype)
+    scale = torch.randn(args.batch, 1, args.dim, device=device, dtype=dtype)
+    shift = torch.randn(args.batch, 1, args.dim, device=device, dtype=dtype)
+    previous_vec = torch.cat([scale, shift], dim=-1) * 1.01
+
+    for tokens in args.tokens:
+        img = torch.randn(args.batch, tokens, args.dim, device=device, dtype=dtype)
+        previous_modulated_inp = img_norm1(img) * 1.01
+
+        def modulated_input():
+            modulated_inp = img_norm1(img) * (1 + scale) + shift
+            return rel_l1(modulated_inp, previous_modulated_inp)
+
+        def modulation():
+            return rel_l1(torch.cat([scale, shift], dim=-1), previous_vec)
+
+        full_ms = timeit(modulated_input, device, args.iters)
+        cheap_ms = timeit(modulation, device, args.iters)
+        print(f"tokens={tokens:6d} dim={args.dim}: modulated_input {full_ms:8.3f} ms, modulation {cheap_ms:8.3f} ms, "
+              f"saved {full_ms - cheap_ms:8.3f} ms per skipped step")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import functools
+import torch
+
+# FasterCache boosts the cached low frequency difference early in the schedule
+# and the high frequency difference late in the schedule.
+FREQ_DELTA_BOOST = 1.1
+FREQ_DELTA_LF_END_PERCENT = 0.8
+FREQ_DELTA_HF_START_PERCENT = 0.6
+
+@functools.lru_cache(maxsize=32)
+def low_freq_mask(height, width, device):
+    """
+    Circular low frequency mask in `torch.fft.rfft2` layout.
+
+    Equivalent to the centered mask used after `fftshift` in the original FasterCache `fft()`,
+    but built directly on the device in the unshifted half-spectrum layout.
+    """
+    radius = min(height, width) // 5
+    freq_y = torch.fft.fftfreq(height, 1.0 / height, device=device)
+    freq_x = torch.fft.rfftfreq(width, 1.0 / width, device=device)
+    return freq_y[:, None] ** 2 + freq_x[None, :] ** 2 <= radius ** 2
+
+class FrequencyDelta:
+    """
+    Cached uncond - cond difference for FasterCache style uncond reconstruction.
+
+    The difference is stored once as a real FFT over the last two (spatial) dims instead of
+    two full complex low/high frequency tensors. The low and high frequency bands are scaled
+    independently and uncond is rebuilt as `cond + irfft2(delta * band_weights)`.
+    """
+    def __init__(self, cond, uncond):
+        self.size = tuple(cond.shape[-2:])
+        self.delta = torch.fft.rfft2((uncond - cond).float())
+        self.lf_scale = 1.0
+        self.hf_scale = 1.0
+
+    def reconstruct(self, cond, boost_lf=False, boost_hf=False):
+        if boost_lf:
+            self.lf_scale *= FREQ_DELTA_BOOST
+        if boost_hf:
+            self.hf_scale *= FREQ_DELTA_BOOST
+
+        delta_fft = self.delta.to(cond.device)
+        if self.lf_scale != 1.0 or self.hf_scale != 1.0:
+            mask = low_freq_mask(*self.size, delta_fft.device)
+            delta_fft = delta_fft * torch.where(mask, self.lf_scale, self.hf_scale)
+        delta = torch.fft.irfft2(delta_fft, s=self.size)
+        return (cond.float() + delta).to(cond.dtype)
+
+    def reconstruct_at(self, cond, current_percent):
+        return self.reconstruct(
+            cond,
+            boost_lf=current_percent <= FREQ_DELTA_LF_END_PERCENT,
+            boost_hf=current_percent >= FREQ_DELTA_HF_START_PERCENT,
+        )
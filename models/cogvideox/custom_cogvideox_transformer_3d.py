@@ -13,6 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import time
+import importlib
+import weakref
 from typing import Any, Dict, Optional, Tuple, Union
 
 import torch
@@ -35,8 +40,9 @@ from diffusers.loaders import PeftAdapterMixin
 from diffusers.models.embeddings import apply_rotary_emb
 from .embeddings import CogVideoXPatchEmbed
 
-from .enhance_a_video.enhance import get_feta_scores
-from .enhance_a_video.globals import is_enhance_enabled, set_num_frames
+from .enhance_a_video.enhance import get_feta_scores_cached
+from .enhance_a_video.globals import is_enhance_enabled, bind_enhance_context, begin_enhance_step, end_enhance_step
+from ...fastercache import FrequencyDelta
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -48,6 +54,67 @@ except:
     SAGEATTN_IS_AVAILABLE = False
 
 from comfy.ldm.modules.attention import optimized_attention
+import folder_paths
+
+# "auto" attention mode: the fastest backend is measured once per shape and remembered on disk
+AUTO_ATTENTION_CANDIDATES = [
+    "sdpa",
+    "comfy",
+    "sageattn",
+    "sageattn_qk_int8_pv_fp16_cuda",
+    "sageattn_qk_int8_pv_fp16_triton",
+    "sageattn_qk_int8_pv_fp8_cuda",
+]
+AUTO_ATTENTION_ITERS = 5
+AUTO_ATTENTION_CACHE_PATH = os.path.join(folder_paths.get_user_directory(), "teacache", "cogvideox_attention_auto.json")
+auto_attention_winners = None
+
+def load_auto_attention_winners():
+    global auto_attention_winners
+    if auto_attention_winners is None:
+        try:
+            with open(AUTO_ATTENTION_CACHE_PATH) as f:
+                auto_attention_winners = json.load(f)
+        except (OSError, ValueError):
+            auto_attention_winners = {}
+    return auto_attention_winners
+
+def save_auto_attention_winners():
+    try:
+        os.makedirs(os.path.dirname(AUTO_ATTENTION_CACHE_PATH), exist_ok=True)
+        with open(AUTO_ATTENTION_CACHE_PATH, "w") as f:
+            json.dump(auto_attention_winners, f, indent=2, sort_keys=True)
+    except OSError as e:
+        logger.warning(f"Could not save the attention benchmark results to {AUTO_ATTENTION_CACHE_PATH}: {e}")
+
+def benchmark_attention_modes(q, k, v, heads, attn_mask=None):
+    timings = {}
+    for mode in AUTO_ATTENTION_CANDIDATES:
+        try:
+            func = set_attention_func(mode, heads)
+            func(q, k, v, attn_mask=attn_mask) # warm up, also filters out backends that do not support the inputs
+            if q.is_cuda:
+                torch.cuda.synchronize(q.device)
+            start = time.perf_counter()
+            for _ in range(AUTO_ATTENTION_ITERS):
+                func(q, k, v, attn_mask=attn_mask)
+            if q.is_cuda:
+                torch.cuda.synchronize(q.device)
+            timings[mode] = (time.perf_counter() - start) / AUTO_ATTENTION_ITERS
+        except Exception as e:
+            logger.debug(f"attention mode {mode} is not usable: {e}")
+    return timings
+
+def get_auto_attention_mode(q, k, v, heads, attn_mask=None):
+    device_name = torch.cuda.get_device_name(q.device) if q.is_cuda else q.device.type
+    key = f"{device_name}|{q.dtype}|heads={heads}|seq={q.shape[2]}|head_dim={q.shape[3]}|mask={attn_mask is not None}"
+    winners = load_auto_attention_winners()
+    if key not in winners:
+        timings = benchmark_attention_modes(q, k, v, heads, attn_mask)
+        winners[key] = min(timings, key=timings.get) if timings else "sdpa"
+        logger.info(f"auto attention for {key}: {winners[key]} ({', '.join(f'{m}={t * 1000:.2f}ms' for m, t in timings.items())})")
+        save_auto_attention_winners()
+    return winners[key]
 
 
 def set_attention_func(attention_mode, heads):
@@ -83,23 +150,19 @@ def set_attention_func(attention_mode, heads):
         def func(q, k, v, is_causal=False, attn_mask=None):
             return sageattn_qk_int8_pv_fp8_cuda(q, k, v, is_causal=is_causal, attn_mask=attn_mask, pv_accum_dtype="fp32+fp32")
         return func
-
-def fft(tensor):
-    tensor_fft = torch.fft.fft2(tensor)
-    tensor_fft_shifted = torch.fft.fftshift(tensor_fft)
-    B, C, H, W = tensor.size()
-    radius = min(H, W) // 5
-            
-    Y, X = torch.meshgrid(torch.arange(H), torch.arange(W))
-    center_x, center_y = W // 2, H // 2
-    mask = (X - center_x) ** 2 + (Y - center_y) ** 2 <= radius ** 2
-    low_freq_mask = mask.unsqueeze(0).unsqueeze(0).to(tensor.device)
-    high_freq_mask = ~low_freq_mask
-            
-    low_freq_fft = tensor_fft_shifted * low_freq_mask
-    high_freq_fft = tensor_fft_shifted * high_freq_mask
-
-    return low_freq_fft, high_freq_fft
+    elif attention_mode == "auto":
+        funcs = {}
+        @torch.compiler.disable()
+        def func(q, k, v, is_causal=False, attn_mask=None):
+            mode = get_auto_attention_mode(q, k, v, heads, attn_mask)
+            if mode not in funcs:
+                funcs[mode] = set_attention_func(mode, heads)
+            out = funcs[mode](q, k, v, is_causal=is_causal, attn_mask=attn_mask)
+            if mode == "comfy":
+                # comfy returns [B, S, H * D], the processor expects [B, H, S, D] for every other mode
+                out = out.view(q.shape[0], -1, heads, q.shape[-1]).transpose(1, 2)
+            return out
+        return func
 
 #region Attention
 class CogVideoXAttnProcessor2_0:
@@ -107,12 +170,15 @@ class CogVideoXAttnProcessor2_0:
     Processor for implementing scaled dot-product attention for the CogVideoX model. It applies a rotary embedding on
     query and key vectors, but does not include spatial normalization.
     """
+    # reads attn.to_qkv when the projections are fused, see fuse_qkv_projections
+    supports_fused_projections = True
 
     def __init__(self, attn_func, attention_mode: Optional[str] = None):
         if not hasattr(F, "scaled_dot_product_attention"):
             raise ImportError("CogVideoXAttnProcessor requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0.")
         self.attention_mode = attention_mode
         self.attn_func = attn_func
+        self.layer_idx = None
     def __call__(
         self,
         attn: Attention,
@@ -133,10 +199,13 @@ class CogVideoXAttnProcessor2_0:
             attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
             attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
 
-        if attn.to_q.weight.dtype == torch.float16 or attn.to_q.weight.dtype == torch.bfloat16:
-            hidden_states = hidden_states.to(attn.to_q.weight.dtype)
+        # fused either by a "fused" attention mode or by fuse_qkv_projections
+        fused = hasattr(attn, "to_qkv")
+        proj_dtype = attn.to_qkv.weight.dtype if fused else attn.to_q.weight.dtype
+        if proj_dtype == torch.float16 or proj_dtype == torch.bfloat16:
+            hidden_states = hidden_states.to(proj_dtype)
 
-        if not "fused" in self.attention_mode:
+        if not fused:
             query = attn.to_q(hidden_states)
             key = attn.to_k(hidden_states)
             value = attn.to_v(hidden_states)
@@ -165,7 +234,7 @@ class CogVideoXAttnProcessor2_0:
 
         #feta
         if is_enhance_enabled():
-            feta_scores = get_feta_scores(attn, query, key, head_dim, text_seq_length)
+            feta_scores = get_feta_scores_cached(attn, query, key, head_dim, text_seq_length, self.layer_idx)
                 
         hidden_states = self.attn_func(query, key, value, attn_mask=attention_mask, is_causal=False)
        
@@ -186,6 +255,114 @@ class CogVideoXAttnProcessor2_0:
 
         return hidden_states, encoder_hidden_states
 
+def fuse_qkv_projections(transformer):
+    """
+    Replace the separate to_q/to_k/to_v projections of every self attention with a single to_qkv
+    linear layer. The separate layers are dropped so the weights are not held twice.
+    Only attentions whose processor declares supports_fused_projections are fused, and layers that
+    are not plain float nn.Linear (quantized, LoRA wrapped, patched forward, ...) are left as they are.
+    """
+    fused = 0
+    for module in transformer.modules():
+        if not isinstance(module, Attention) or hasattr(module, "to_qkv") or module.is_cross_attention:
+            continue
+        if not getattr(module.processor, "supports_fused_projections", False):
+            continue
+        projections = [getattr(module, name, None) for name in ("to_q", "to_k", "to_v")]
+        if any(type(proj) is not nn.Linear or "forward" in proj.__dict__ for proj in projections):
+            continue
+        weight = projections[0].weight
+        if weight.dtype not in (torch.float32, torch.float16, torch.bfloat16):
+            continue
+        if any(proj.weight.dtype != weight.dtype or proj.weight.device != weight.device or proj.weight.shape[1] != weight.shape[1] for proj in projections):
+            continue
+        has_bias = projections[0].bias is not None
+        if any((proj.bias is not None) != has_bias for proj in projections):
+            continue
+
+        with torch.no_grad():
+            to_qkv = nn.Linear(weight.shape[1], sum(proj.weight.shape[0] for proj in projections), bias=has_bias, device="meta")
+            to_qkv.weight = nn.Parameter(torch.cat([proj.weight for proj in projections]), requires_grad=False)
+            if has_bias:
+                to_qkv.bias = nn.Parameter(torch.cat([proj.bias for proj in projections]), requires_grad=False)
+        module.to_qkv = to_qkv
+        del module.to_q, module.to_k, module.to_v
+        module.fused_projections = True
+        fused += 1
+    return fused
+
+def set_attention_mode(transformer, attention_mode):
+    """
+    Switch the attention backend of every processor in `transformer` that dispatches through
+    attn_func (CogVideoXAttnProcessor2_0 and compatible ones), e.g. to "auto". Returns the number of
+    attentions switched.
+    """
+    switched = 0
+    for module in transformer.modules():
+        if isinstance(module, Attention) and hasattr(module.processor, "attn_func") and hasattr(module.processor, "attention_mode"):
+            module.processor.attn_func = set_attention_func(attention_mode, module.heads)
+            module.processor.attention_mode = attention_mode
+            switched += 1
+    transformer.attention_mode = attention_mode
+    return switched
+
+def set_teacache_pipe(transformer, pipe):
+    # weak, the pipe holds the transformer
+    transformer.teacache_pipe = weakref.ref(pipe)
+
+def get_teacache_scheduler(transformer):
+    """
+    Scheduler of the pipe running `transformer`. The CogVideoXWrapper sampler replaces pipe.scheduler
+    for every sampling, so it is looked up when the forward runs, not when the node is applied.
+    """
+    pipe_ref = transformer.__dict__.get("teacache_pipe")
+    pipe = pipe_ref() if pipe_ref is not None else None
+    return getattr(pipe, "scheduler", None)
+
+def find_enhance_globals(transformer):
+    """
+    Enhance-A-Video globals module of the package that defined the transformer class, None for the
+    vendored model. The CogVideoXWrapper sampler enables FETA and sets its weight there.
+    """
+    package = type(transformer).__module__.rpartition(".")[0]
+    if not package or type(transformer).__module__ == __name__:
+        return None
+    try:
+        module = importlib.import_module(f"{package}.enhance_a_video.globals")
+    except ImportError:
+        return None
+    if not hasattr(module, "is_enhance_enabled") or not hasattr(module, "get_enhance_weight"):
+        return None
+    return module
+
+def install_attention_processors(transformer):
+    """
+    The transformer is built by the CogVideoXWrapper loader, so its self attentions run the wrapper's
+    processors and the vendored __init__ that sets layer_idx never ran. Install this repo's
+    CogVideoXAttnProcessor2_0 (keeping the attention mode) on every block attn1 and number the
+    layers, so the Enhance-A-Video score cache and settings, q/k/v fusion and attention modes of this
+    repo apply to it. Returns the number of processors installed or renumbered.
+    """
+    installed = 0
+    for i, block in enumerate(getattr(transformer, "transformer_blocks", None) or []):
+        attn = getattr(block, "attn1", None)
+        if not isinstance(attn, Attention) or attn.is_cross_attention:
+            continue
+        processor = attn.processor
+        if not isinstance(processor, CogVideoXAttnProcessor2_0):
+            attention_mode = getattr(processor, "attention_mode", None) or getattr(transformer, "attention_mode", None) or "sdpa"
+            attn_func = set_attention_func(attention_mode, attn.heads)
+            if attn_func is None:
+                # a mode of the wrapper this repo does not know, sdpa gives the same result
+                attention_mode = "sdpa"
+                attn_func = set_attention_func(attention_mode, attn.heads)
+            processor = CogVideoXAttnProcessor2_0(attn_func, attention_mode=attention_mode)
+            attn.set_processor(processor)
+        processor.layer_idx = i
+        installed += 1
+    transformer.enhance_globals = find_enhance_globals(transformer)
+    return installed
+
 #region Blocks
 @maybe_allow_in_graph
 class CogVideoXBlock(nn.Module):
@@ -505,6 +682,9 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
                 for _ in range(num_layers)
             ]
         )
+        # layer index keys the cross-step Enhance-A-Video score cache
+        for i, block in enumerate(self.transformer_blocks):
+            block.attn1.processor.layer_idx = i
         self.norm_final = nn.LayerNorm(inner_dim, norm_eps, norm_elementwise_affine)
 
         # 4. Output blocks
@@ -534,6 +714,7 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
         self.fastercache_hf_step = 30
         self.fastercache_device = "cuda"
         self.fastercache_num_blocks_to_cache = len(self.transformer_blocks)
+        self.fastercache_freq_delta = None
         self.attention_mode = attention_mode
         
 
@@ -555,7 +736,8 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
     ):
         batch_size, num_frames, channels, height, width = hidden_states.shape
 
-        set_num_frames(num_frames) #enhance a video global
+        bind_enhance_context(self, num_frames) #enhance a video context of this thread
+        begin_enhance_step(timestep, scheduler=get_teacache_scheduler(self))
    
         # 1. Time embedding
         timesteps = timestep
@@ -643,23 +825,16 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
                 )
                 output = output.permute(0, 1, 5, 4, 2, 6, 3, 7).flatten(6, 7).flatten(4, 5).flatten(1, 2)
             
-            (bb, tt, cc, hh, ww) = output.shape
-            cond = rearrange(output, "B T C H W -> (B T) C H W", B=bb, C=cc, T=tt, H=hh, W=ww)
-            lf_c, hf_c = fft(cond.float())
             #lf_step = 40
             #hf_step = 30
-            if self.fastercache_counter <= self.fastercache_lf_step:
-                self.delta_lf = self.delta_lf * 1.1
-            if self.fastercache_counter >= self.fastercache_hf_step:
-                self.delta_hf = self.delta_hf * 1.1
-   
-            new_hf_uc = self.delta_hf + hf_c
-            new_lf_uc = self.delta_lf + lf_c
-
-            combine_uc = new_lf_uc + new_hf_uc
-            combined_fft = torch.fft.ifftshift(combine_uc)
-            recovered_uncond = torch.fft.ifft2(combined_fft).real
-            recovered_uncond = rearrange(recovered_uncond.to(output.dtype), "(B T) C H W -> B T C H W", B=bb, C=cc, T=tt, H=hh, W=ww)
+            if self.fastercache_freq_delta is not None:
+                recovered_uncond = self.fastercache_freq_delta.reconstruct(
+                    output,
+                    boost_lf=self.fastercache_counter <= self.fastercache_lf_step,
+                    boost_hf=self.fastercache_counter >= self.fastercache_hf_step,
+                )
+            else:
+                recovered_uncond = output
             output = torch.cat([output, recovered_uncond])
         else:
             for i, block in enumerate(self.transformer_blocks):
@@ -717,17 +892,10 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
                 )
                 output = output.permute(0, 1, 5, 4, 2, 6, 3, 7).flatten(6, 7).flatten(4, 5).flatten(1, 2)
 
-            if self.fastercache_counter >= self.fastercache_start_step + 1: 
-                (bb, tt, cc, hh, ww) = output.shape
-                cond = rearrange(output[0:1].float(), "B T C H W -> (B T) C H W", B=bb//2, C=cc, T=tt, H=hh, W=ww)
-                uncond = rearrange(output[1:2].float(), "B T C H W -> (B T) C H W", B=bb//2, C=cc, T=tt, H=hh, W=ww)
-
-                lf_c, hf_c = fft(cond)
-                lf_uc, hf_uc = fft(uncond)
-
-                self.delta_lf = lf_uc - lf_c
-                self.delta_hf = hf_uc - hf_c
+            if self.fastercache_counter >= self.fastercache_start_step + 1:
+                self.fastercache_freq_delta = FrequencyDelta(output[0:1], output[1:2])
 
+        end_enhance_step()
         if not return_dict:
             return (output,)
         return Transformer2DModelOutput(sample=output)
@@ -1,10 +1,74 @@
+import threading
 import torch
 import torch.nn as nn
 import numpy as np
+from collections import OrderedDict
 from typing import Tuple, Union, Optional
 from diffusers.models.embeddings import get_3d_sincos_pos_embed, get_1d_rotary_pos_embed
 
 
+class EmbeddingCache:
+    """
+    Bounded LRU cache for positional embeddings, so they are built once per resolution.
+    """
+    def __init__(self, maxsize: int = 8):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # the model may be shared by pipelines running in several threads
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        # build outside the lock, a concurrent miss on the same key just builds it twice
+        value = build()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxsize": self.maxsize}
+
+def cache_positional_embeddings(patch_embed):
+    """
+    The patch embedding of the model loaded by the CogVideoXWrapper rebuilds its sincos positional
+    embeddings on the host for every forward whose resolution differs from the sample config. Wrap
+    its _get_positional_embeddings in an EmbeddingCache so they are built once per resolution.
+    Returns False when the module has no positional embeddings to cache.
+    """
+    if isinstance(patch_embed, CogVideoXPatchEmbed) or "_get_positional_embeddings" in patch_embed.__dict__:
+        # the vendored patch embedding caches them itself, or the wrapper is installed already
+        return True
+    build = getattr(patch_embed, "_get_positional_embeddings", None)
+    if build is None or not (getattr(patch_embed, "use_positional_embeddings", False) or getattr(patch_embed, "use_learned_positional_embeddings", False)):
+        return False
+    cache = EmbeddingCache()
+
+    def _get_positional_embeddings(*args, **kwargs):
+        key = args + tuple((name, str(value)) for name, value in sorted(kwargs.items()))
+        return cache.get(key, lambda: build(*args, **kwargs))
+
+    patch_embed._get_positional_embeddings = _get_positional_embeddings
+    patch_embed.pos_embedding_cache = cache
+    return True
+
+
 class CogVideoXPatchEmbed(nn.Module):
     def __init__(
         self,
@@ -54,6 +118,8 @@ class CogVideoXPatchEmbed(nn.Module):
             persistent = use_learned_positional_embeddings
             pos_embedding = self._get_positional_embeddings(sample_height, sample_width, sample_frames)
             self.register_buffer("pos_embedding", pos_embedding, persistent=persistent)
+        # embeddings for resolutions other than the sample config, keyed by (height, width, frames, dtype, device)
+        self.pos_embedding_cache = EmbeddingCache()
 
     def _get_positional_embeddings(self, sample_height: int, sample_width: int, sample_frames: int) -> torch.Tensor:
         post_patch_height = sample_height // self.patch_size
@@ -123,8 +189,10 @@ class CogVideoXPatchEmbed(nn.Module):
                 or self.sample_width != width
                 or self.sample_frames != pre_time_compression_frames
             ):
-                pos_embedding = self._get_positional_embeddings(height, width, pre_time_compression_frames)
-                pos_embedding = pos_embedding.to(embeds.device, dtype=embeds.dtype)
+                pos_embedding = self.pos_embedding_cache.get(
+                    (height, width, pre_time_compression_frames, embeds.dtype, embeds.device),
+                    lambda: self._get_positional_embeddings(height, width, pre_time_compression_frames).to(embeds.device, dtype=embeds.dtype),
+                )
             else:
                 pos_embedding = self.pos_embedding
 
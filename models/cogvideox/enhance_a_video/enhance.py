@@ -1,7 +1,9 @@
+import functools
+import time
 import torch
-from einops import rearrange
 from diffusers.models.attention import Attention
-from .globals import get_enhance_weight, get_num_frames
+from .globals import get_enhance_weight, get_enhance_workspace, get_enhance_num_samples, get_num_frames
+from .globals import is_enhance_cache_enabled, is_enhance_report_enabled, get_cached_feta_scores, store_feta_scores
 
 # def get_feta_scores(query, key):
 #     img_q, img_k = query, key
@@ -37,46 +39,82 @@ def get_feta_scores(
         num_frames = get_num_frames()
         spatial_dim = int((query.shape[2] - text_seq_length) / num_frames)
 
-        query_image = rearrange(
-            query[:, :, text_seq_length:],
-            "B N (T S) C -> (B S) N T C",
-            N=attn.heads,
-            T=num_frames,
-            S=spatial_dim,
-            C=head_dim,
-        )
-        key_image = rearrange(
-            key[:, :, text_seq_length:],
-            "B N (T S) C -> (B S) N T C",
-            N=attn.heads,
-            T=num_frames,
-            S=spatial_dim,
-            C=head_dim,
-        )
+        # "B N (T S) C -> B N T S C" as views, feta_score only gathers the tokens it needs
+        query_image = query[:, :, text_seq_length:].unflatten(2, (num_frames, spatial_dim))
+        key_image = key[:, :, text_seq_length:].unflatten(2, (num_frames, spatial_dim))
         return feta_score(query_image, key_image, head_dim, num_frames)
 
+def get_feta_scores_cached(
+        attn: Attention,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        head_dim: int,
+        text_seq_length: int,
+        layer_idx,
+    ) -> torch.Tensor:
+        if not is_enhance_cache_enabled() or layer_idx is None:
+            return get_feta_scores(attn, query, key, head_dim, text_seq_length)
+
+        feta_scores = get_cached_feta_scores(layer_idx)
+        if feta_scores is not None:
+            return feta_scores
+
+        if not is_enhance_report_enabled():
+            feta_scores = get_feta_scores(attn, query, key, head_dim, text_seq_length)
+            store_feta_scores(layer_idx, feta_scores, 0.0)
+            return feta_scores
+
+        # synchronize so the report reflects the actual score computation time
+        if query.is_cuda:
+            torch.cuda.synchronize(query.device)
+        start = time.perf_counter()
+        feta_scores = get_feta_scores(attn, query, key, head_dim, text_seq_length)
+        if query.is_cuda:
+            torch.cuda.synchronize(query.device)
+        store_feta_scores(layer_idx, feta_scores, time.perf_counter() - start)
+        return feta_scores
+
+@functools.lru_cache(maxsize=16)
+def get_sample_indices(num_tokens, num_samples, device):
+    if num_samples <= 0 or num_samples >= num_tokens:
+        return None
+    generator = torch.Generator().manual_seed(0)
+    return torch.randperm(num_tokens, generator=generator)[:num_samples].sort().values.to(device)
+
 def feta_score(query_image, key_image, head_dim, num_frames):
+    # query_image, key_image: [B, N, T, S, C]
+    batch_size, heads, _, spatial_dim, _ = query_image.shape
     scale = head_dim**-0.5
-    query_image = query_image * scale
-    attn_temp = query_image @ key_image.transpose(-2, -1)  # translate attn to float32
-    attn_temp = attn_temp.to(torch.float32)
-    attn_temp = attn_temp.softmax(dim=-1)
 
-    # Reshape to [batch_size * num_tokens, num_frames, num_frames]
-    attn_temp = attn_temp.reshape(-1, num_frames, num_frames)
+    token_indices = get_sample_indices(spatial_dim, get_enhance_num_samples(), query_image.device)
+    num_tokens = spatial_dim if token_indices is None else len(token_indices)
 
-    # Create a mask for diagonal elements
-    diag_mask = torch.eye(num_frames, device=attn_temp.device).bool()
-    diag_mask = diag_mask.unsqueeze(0).expand(attn_temp.shape[0], -1, -1)
+    # Stream over spatial tokens so that the fp32 [B, s, N, T, T] workspace stays bounded
+    bytes_per_token = batch_size * heads * num_frames * num_frames * 4 * 2
+    chunk_size = max(1, int(get_enhance_workspace() * 1024 * 1024 // bytes_per_token))
 
-    # Zero out diagonal elements
-    attn_wo_diag = attn_temp.masked_fill(diag_mask, 0)
+    # Every softmax row sums to 1, so the off-diagonal mass of a [T, T] matrix is T minus its trace
+    diag_sum = torch.zeros((), device=query_image.device, dtype=torch.float32)
+    for start in range(0, num_tokens, chunk_size):
+        end = min(start + chunk_size, num_tokens)
+        if token_indices is None:
+            query_chunk = query_image[:, :, :, start:end]
+            key_chunk = key_image[:, :, :, start:end]
+        else:
+            query_chunk = query_image.index_select(3, token_indices[start:end])
+            key_chunk = key_image.index_select(3, token_indices[start:end])
+        query_chunk = query_chunk.permute(0, 3, 1, 2, 4) * scale  # [B, s, N, T, C]
+        key_chunk = key_chunk.permute(0, 3, 1, 2, 4)
+        attn_temp = (query_chunk @ key_chunk.transpose(-2, -1)).to(torch.float32)  # translate attn to float32
+        log_diag = attn_temp.diagonal(dim1=-2, dim2=-1) - attn_temp.logsumexp(dim=-1)
+        diag_sum += log_diag.exp().sum()
 
-    # Calculate mean for each token's attention matrix
+    # Mean over every token's attention matrix
     # Number of off-diagonal elements per matrix is n*n - n
+    num_matrices = batch_size * num_tokens * heads
     num_off_diag = num_frames * num_frames - num_frames
-    mean_scores = attn_wo_diag.sum(dim=(1, 2)) / num_off_diag
+    mean_scores = (num_frames - diag_sum / num_matrices) / num_off_diag
 
-    enhance_scores = mean_scores.mean() * (num_frames + get_enhance_weight())
+    enhance_scores = mean_scores * (num_frames + get_enhance_weight())
     enhance_scores = enhance_scores.clamp(min=1)
     return enhance_scores
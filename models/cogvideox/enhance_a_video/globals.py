@@ -1,31 +1,188 @@
-NUM_FRAMES = None
-FETA_WEIGHT = None
-ENABLE_FETA = False
+import contextvars
+import dataclasses
+
+# Enhance-A-Video state lives in a context object instead of module globals so that
+# pipelines running in different threads do not race on each other. Setters replace the
+# context of the calling thread (copy-on-write), and every transformer forward binds its own
+# num_frames and score cache on top of the caller's settings.
+
+def new_score_cache():
+    return {
+        "step": 0,
+        "timestep": None,
+        "step_index": None,
+        "last_step": False,
+        "reported": False,
+        "refresh": True,
+        "scores": {},
+        "computed": 0,
+        "reused": 0,
+        "compute_time": 0.0,
+    }
+
+@dataclasses.dataclass
+class EnhanceContext:
+    enabled: bool = False
+    weight: float = None
+    num_frames: int = None
+    workspace_mb: float = 256 # fp32 attention workspace budget for feta_score
+    num_samples: int = 0 # 0 uses every spatial token
+    refresh_interval: int = 1 # recompute the scores every N steps, 1 recomputes every step
+    refresh_thresh: float = 0.0 # also recompute when the TeaCache relative change exceeds this, 0 disables
+    report: bool = False # time the score computation and print a report at the end of every run
+    score_cache: dict = dataclasses.field(default_factory=new_score_cache)
+
+# no shared default instance, every thread creates its own context (and score cache) on first use
+ENHANCE_CONTEXT = contextvars.ContextVar("enhance_a_video_context", default=None)
+
+def get_enhance_context() -> EnhanceContext:
+    context = ENHANCE_CONTEXT.get()
+    if context is None:
+        context = EnhanceContext()
+        ENHANCE_CONTEXT.set(context)
+    return context
+
+def update_enhance_context(**changes):
+    ENHANCE_CONTEXT.set(dataclasses.replace(get_enhance_context(), **changes))
+
+def bind_enhance_context(owner, num_frames: int):
+    """
+    Bind num_frames and the score cache of `owner` (the transformer) to the calling thread,
+    keeping the Enhance-A-Video settings that are currently active there. The enable flag and
+    weight are read from `owner.enhance_globals` when the model comes from a wrapper package.
+    """
+    score_cache = owner.__dict__.setdefault("enhance_score_cache", new_score_cache())
+    changes = {"num_frames": num_frames, "score_cache": score_cache}
+    source = owner.__dict__.get("enhance_globals")
+    if source is not None:
+        # a wrapper model, its sampler enables FETA and sets the weight in its own globals
+        changes.update(enabled=source.is_enhance_enabled(), weight=source.get_enhance_weight())
+    update_enhance_context(**changes)
+
 
 def set_num_frames(num_frames: int):
-    global NUM_FRAMES
-    NUM_FRAMES = num_frames
+    update_enhance_context(num_frames=num_frames)
 
 
 def get_num_frames() -> int:
-    return NUM_FRAMES
+    return get_enhance_context().num_frames
 
 
 def enable_enhance():
-    global ENABLE_FETA
-    ENABLE_FETA = True
+    update_enhance_context(enabled=True)
 
 def disable_enhance():
-    global ENABLE_FETA
-    ENABLE_FETA = False
+    update_enhance_context(enabled=False)
 
 def is_enhance_enabled() -> bool:
-    return ENABLE_FETA
+    return get_enhance_context().enabled
 
 def set_enhance_weight(feta_weight: float):
-    global FETA_WEIGHT
-    FETA_WEIGHT = feta_weight
+    update_enhance_context(weight=feta_weight)
 
 
 def get_enhance_weight() -> float:
-    return FETA_WEIGHT
+    return get_enhance_context().weight
+
+
+def set_enhance_workspace(workspace_mb: float):
+    update_enhance_context(workspace_mb=workspace_mb)
+
+
+def get_enhance_workspace() -> float:
+    return get_enhance_context().workspace_mb
+
+def set_enhance_num_samples(num_samples: int):
+    update_enhance_context(num_samples=num_samples)
+
+
+def get_enhance_num_samples() -> int:
+    return get_enhance_context().num_samples
+
+
+def set_enhance_refresh(interval: int, thresh: float = 0.0):
+    update_enhance_context(refresh_interval=max(1, interval), refresh_thresh=thresh)
+
+
+def is_enhance_cache_enabled() -> bool:
+    return get_enhance_context().refresh_interval > 1
+
+def set_enhance_report(report: bool):
+    update_enhance_context(report=report)
+
+
+def is_enhance_report_enabled() -> bool:
+    return get_enhance_context().report
+
+def reset_enhance_cache():
+    get_enhance_context().score_cache.update(new_score_cache())
+
+def get_scheduler_step(scheduler, timestep):
+    timesteps = getattr(scheduler, "timesteps", None)
+    if timesteps is None or len(timesteps) == 0:
+        return None, None
+    # the pipeline passes the scheduler timesteps as they are, so the closest one is the current step
+    step_index = (timesteps.float().cpu() - timestep).abs().argmin().item()
+    return step_index, len(timesteps)
+
+def print_enhance_cache_report():
+    context = get_enhance_context()
+    state = context.score_cache
+    if context.report and not state["reported"] and state["computed"] + state["reused"] > 0:
+        print(f"[TeaCache] {get_enhance_cache_report()}")
+    state["reported"] = True
+
+def begin_enhance_step(timestep, rel_change=None, scheduler=None):
+    """
+    Called once per transformer forward. Decides whether the FETA scores are recomputed this step.
+    A new run is detected from the scheduler step index, or from an increasing timestep when there
+    is no scheduler, and clears the cached scores.
+    """
+    context = get_enhance_context()
+    state = context.score_cache
+    if hasattr(timestep, "flatten"):
+        timestep = timestep.flatten()[0].item()
+    step_index, num_steps = get_scheduler_step(scheduler, timestep)
+    if step_index is not None:
+        new_run = state["step_index"] is None or step_index < state["step_index"]
+    else:
+        new_run = state["timestep"] is None or timestep > state["timestep"]
+    if new_run:
+        # a run that stopped before its last step has not been reported yet
+        print_enhance_cache_report()
+        reset_enhance_cache()
+    state["timestep"] = timestep
+    state["step_index"] = step_index
+    state["last_step"] = step_index is not None and step_index == num_steps - 1
+
+    refresh = state["step"] % context.refresh_interval == 0
+    if rel_change is not None and context.refresh_thresh > 0 and rel_change >= context.refresh_thresh:
+        refresh = True
+    state["refresh"] = refresh
+    state["step"] += 1
+
+def end_enhance_step():
+    if get_enhance_context().score_cache["last_step"]:
+        print_enhance_cache_report()
+
+def get_cached_feta_scores(layer_idx):
+    state = get_enhance_context().score_cache
+    if state["refresh"]:
+        return None
+    scores = state["scores"].get(layer_idx)
+    if scores is not None:
+        state["reused"] += 1
+    return scores
+
+def store_feta_scores(layer_idx, scores, elapsed):
+    state = get_enhance_context().score_cache
+    state["scores"][layer_idx] = scores
+    state["computed"] += 1
+    state["compute_time"] += elapsed
+
+def get_enhance_cache_report() -> str:
+    state = get_enhance_context().score_cache
+    computed, reused = state["computed"], state["reused"]
+    avg_ms = state["compute_time"] / computed * 1000 if computed else 0.0
+    saved = avg_ms * reused / 1000
+    return f"Enhance-A-Video scores: computed {computed}, reused {reused}, avg {avg_ms:.2f} ms per layer, ~{saved:.2f} s of attention-layer time saved"
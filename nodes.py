@@ -1,18 +1,30 @@
+import os
 import math
+import time
+import types
+import hashlib
+import itertools
+import threading
+import contextlib
+import collections
 import torch
+import folder_paths
+import comfy.samplers
 import comfy.ldm.common_dit
 import comfy.model_management as mm
 
 from torch import Tensor
 from einops import repeat
 from typing import Optional
-from unittest.mock import patch
 
-from comfy.ldm.flux.layers import timestep_embedding, apply_mod
+from comfy.ldm.flux.layers import timestep_embedding, apply_mod, ModulationOut
+from comfy.ldm.flux.math import attention
 from comfy.ldm.lightricks.model import precompute_freqs_cis
 from comfy.ldm.lightricks.symmetric_patchifier import latent_to_pixel_coords
 from comfy.ldm.wan.model import sinusoidal_embedding_1d
 
+from .fastercache import FrequencyDelta
+
 
 SUPPORTED_MODELS_COEFFICIENTS = {
     "flux": [4.98651651e+02, -2.83781631e+02, 5.58554382e+01, -3.82021401e+00, 2.64230861e-01],
@@ -37,6 +49,371 @@ def poly1d(coefficients, x):
         result += coeff * (x ** (len(coefficients) - 1 - i))
     return result
 
+def get_step_index(sigmas, timestep):
+    # referenced from https://github.com/kijai/ComfyUI-KJNodes/blob/d126b62cebee81ea14ec06ea7cd7526999cb0554/nodes/model_optimization_nodes.py#L868
+    matched_step_index = (sigmas == timestep).nonzero()
+    if len(matched_step_index) > 0:
+        return matched_step_index[0].item()
+    for i in range(len(sigmas) - 1):
+        # walk from beginning of steps until crossing the timestep
+        if (sigmas[i] - timestep) * (sigmas[i + 1] - timestep) <= 0:
+            return i
+    return 0
+
+# interleaved generations kept per TeaCache model, the least recently used run is evicted
+TEACACHE_MAX_RUNS = 8
+
+class TeaCacheRuns:
+    """
+    Bounded registry of per-run TeaCache states, so generations sampled concurrently or interleaved
+    on one model do not share caches. A run is keyed by `transformer_options["teacache_run_id"]`
+    when the caller sets one, and by the identity of the sampling sigmas otherwise.
+
+    Runs started by the sampler wrapper (`start`/`finish`) span exactly one sampling call. With
+    stage_cache "inherit" the last finished run is kept until the next stage of a chained sampling
+    inherits its cache. Runs keyed by the sigmas are never finished, the ones that reached their
+    last step are dropped when the next one starts.
+    """
+    def __init__(self, max_runs=TEACACHE_MAX_RUNS):
+        self.max_runs = max_runs
+        self.runs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.run_ids = itertools.count()
+        self.last_run = None
+
+    def start(self, sigmas, inherit=False):
+        run = {'sigmas': sigmas, 'sampler_run': True, 'callback_step': -1, 'step_evals': {}, 'evals_per_step': None}
+        with self.lock:
+            last_run = self.last_run
+            # a stage continues the previous one when it starts at the sigma the previous one ended at
+            if inherit and last_run is not None and 'teacache_states' in last_run and math.isclose(
+                    float(last_run['sigmas'][-1]), float(sigmas[0]), rel_tol=1e-5, abs_tol=1e-8):
+                run['teacache_states'] = last_run['teacache_states']
+                self.last_run = None
+            run_id = ("run", next(self.run_ids))
+            self.runs[run_id] = run
+            while len(self.runs) > self.max_runs:
+                self.runs.popitem(last=False)
+        return run_id
+
+    def advance(self, run_id, step):
+        # sampler callback of `step`, it is called after the first evaluation of the step
+        with self.lock:
+            run = self.runs.get(run_id)
+        if run is None:
+            return
+        if step > 0 and run['step_evals']:
+            # the evaluations since the previous callback are the rest of that step and the first of this one
+            evals_per_step = max(run['step_evals'].values())
+            if run['evals_per_step'] is None and evals_per_step > 1:
+                # they were labelled as first order steps until now, restart the sub-step slots
+                run.pop('teacache_states', None)
+            run['evals_per_step'] = evals_per_step
+        run['callback_step'] = step
+        run['step_evals'] = {}
+
+    def finish(self, run_id, keep=False):
+        with self.lock:
+            run = self.runs.pop(run_id, None)
+            # only hold on to the caches (and their tensors) when a next stage may inherit them
+            self.last_run = run if keep else None
+
+    def get(self, transformer_options):
+        sigmas = transformer_options["sample_sigmas"]
+        run_id = transformer_options.get("teacache_run_id")
+        by_sigmas = run_id is None
+        if by_sigmas:
+            run_id = ("sigmas", id(sigmas))
+        with self.lock:
+            run = self.runs.get(run_id)
+            if run is None:
+                if by_sigmas:
+                    # release the caches (and their tensors) of the sigmas runs that are done
+                    for key in [key for key, old in self.runs.items() if old.get('by_sigmas') and old.get('last_step')]:
+                        del self.runs[key]
+                # the run holds on to its sigmas, so their id is not reused while it is registered
+                run = self.runs[run_id] = {'sigmas': sigmas, 'by_sigmas': by_sigmas}
+                while len(self.runs) > self.max_runs:
+                    self.runs.popitem(last=False)
+            else:
+                self.runs.move_to_end(run_id)
+        return run
+
+def get_teacache_run(model, transformer_options):
+    run = transformer_options.get("teacache_run")
+    if run is None:
+        # called without the TeaCache unet wrapper, keep a single run on the model
+        run = model.__dict__.setdefault('teacache_run', {})
+    return run
+
+def get_teacache_state(model, transformer_options, new_state):
+    """
+    TeaCache state of the current run. Multi-evaluation samplers (Heun, DPM-2, DPM++ SDE) get a
+    separate state per sub-step, so every slot compares an evaluation with the same evaluation of
+    the previous step and corrector evaluations are skipped independently.
+    """
+    states = get_teacache_run(model, transformer_options).setdefault('teacache_states', {})
+    substep = transformer_options.get("teacache_substep", 0)
+    if substep not in states:
+        states[substep] = new_state()
+    return states[substep]
+
+# more evaluations per step than any supported sampler makes, the sampler is not reporting its steps
+MAX_SUBSTEPS = 4
+
+def count_substep(run, cond_or_uncond):
+    """
+    Step and sub-step of a model evaluation in a sampler run. The sampler callback of step i is
+    called after the first evaluation of step i, so of the n evaluations per step counted between
+    two callbacks, the first n - 1 after callback i are the correctors (sub-steps 1..) of step i and
+    the last one is sub-step 0 of step i + 1. Until the second callback has measured n, every
+    evaluation is taken as the first of the next step.
+    """
+    step_evals = run['step_evals']
+    index = max(step_evals.get(k, 0) for k in cond_or_uncond)
+    for k in cond_or_uncond:
+        step_evals[k] = index + 1
+    if index >= MAX_SUBSTEPS:
+        run['sampler_steps'] = False
+
+    step = run['callback_step']
+    if step < 0:
+        return 0, index
+    correctors = (run['evals_per_step'] or 1) - 1
+    if index < correctors:
+        return step, index + 1
+    return step + 1, index - correctors
+
+def take_rows(x, rows):
+    if x is None:
+        return None
+    if isinstance(x, (list, tuple)):
+        return type(x)(take_rows(t, rows) for t in x)
+    return x[rows]
+
+def use_uncond_shortcut(teacache_state, cond_or_uncond, enable_teacache, uncond_reuse):
+    # only cond needs recomputation, uncond is rebuilt from the cached cond/uncond difference
+    if not enable_teacache or uncond_reuse == "disabled" or sorted(cond_or_uncond) != [0, 1]:
+        return False
+    return (
+        teacache_state[0]['should_calc']
+        and not teacache_state[1]['should_calc']
+        and teacache_state[1]['uncond_delta'] is not None
+    )
+
+def update_uncond_delta(teacache_state, cond_or_uncond, output, uncond_reuse):
+    if uncond_reuse == "disabled" or sorted(cond_or_uncond) != [0, 1]:
+        return
+    b = len(output) // len(cond_or_uncond)
+    i_c, i_uc = cond_or_uncond.index(0), cond_or_uncond.index(1)
+    cond, uncond = output[i_c*b:(i_c+1)*b], output[i_uc*b:(i_uc+1)*b]
+    if uncond_reuse == "freq_delta":
+        # output must be spatial, the difference is split over the last two dims
+        teacache_state[1]['uncond_delta'] = FrequencyDelta(cond, uncond)
+    else:
+        teacache_state[1]['uncond_delta'] = uncond - cond
+
+def reconstruct_uncond(teacache_state, cond_or_uncond, cond_output, current_percent=0.0):
+    uncond_delta = teacache_state[1]['uncond_delta']
+    if isinstance(uncond_delta, FrequencyDelta):
+        uncond_output = uncond_delta.reconstruct_at(cond_output, current_percent)
+    else:
+        uncond_output = cond_output + uncond_delta.to(cond_output)
+    return torch.cat([cond_output if k == 0 else uncond_output for k in cond_or_uncond])
+
+SKIP_SIGNAL_CALIBRATION_STEPS = 2
+
+def rel_l1(current, previous):
+    return (current - previous).abs().mean() / (previous.abs().mean() + 1e-8)
+
+def same_input(cached, version, x):
+    if cached is None or x is None:
+        return cached is x
+    if cached is x:
+        # same tensor, unchanged unless it was modified in place
+        return x._version == version
+    # ComfyUI rebuilds the conditioning batch every step, compare the values
+    return cached.shape == x.shape and cached.dtype == x.dtype and cached.device == x.device and torch.equal(cached, x)
+
+def cached_projection(run, key, fn, *inputs):
+    """
+    Conditioning projections only feed the blocks and do not change during a sampling run. They are
+    computed when the blocks run and reused for as long as the inputs are unchanged. The cache is
+    owned by the run and shared by its sub-step slots, so it is dropped when a new run starts.
+    `key` holds the projection name and the computed branches (cond_or_uncond).
+    """
+    projections = run.setdefault('projections', {})
+    entry = projections.get(key)
+    if entry is not None:
+        cached_inputs, versions, output = entry
+        if len(cached_inputs) == len(inputs) and all(same_input(c, v, x) for c, v, x in zip(cached_inputs, versions, inputs)):
+            return output
+    output = fn(*inputs)
+    projections[key] = (inputs, tuple(x._version if x is not None else None for x in inputs), output)
+    return output
+
+def skip_signal_rel_l1(cache, skip_signal, mod, modulated_input_fn):
+    """
+    Relative L1 change of the current step used by the TeaCache skip test, None at the first step.
+
+    "modulated_input" compares the modulated image tokens of the first block (the signal the
+    coefficients were fitted on). "modulation" compares only the modulation scale/shift vectors,
+    which skips the full-size img_norm1/modulation pass. Its change is mapped onto the modulated
+    input signal by a ratio measured with both signals on the first steps of the run, so the same
+    coefficients and rel_l1_thresh stay meaningful.
+    """
+    if skip_signal != "modulation":
+        modulated_inp = modulated_input_fn()
+        previous = cache['previous_modulated_input']
+        cache['previous_modulated_input'] = modulated_inp
+        return rel_l1(modulated_inp, previous) if previous is not None else None
+
+    mod_vec = torch.cat([mod.scale, mod.shift], dim=-1)
+    previous_vec = cache.get('previous_mod_vec')
+    cache['previous_mod_vec'] = mod_vec
+    calibration = cache.setdefault('signal_calibration', {'full': 0.0, 'cheap': 0.0, 'count': 0})
+    if calibration['count'] < SKIP_SIGNAL_CALIBRATION_STEPS:
+        modulated_inp = modulated_input_fn()
+        previous = cache['previous_modulated_input']
+        cache['previous_modulated_input'] = modulated_inp
+        if previous is None or previous_vec is None:
+            return None
+        full = rel_l1(modulated_inp, previous)
+        calibration['full'] += full
+        calibration['cheap'] += rel_l1(mod_vec, previous_vec)
+        calibration['count'] += 1
+        return full
+    return rel_l1(mod_vec, previous_vec) * calibration['full'] / (calibration['cheap'] + 1e-8)
+
+def schedule_step_index(schedule_timesteps, timesteps):
+    """
+    Row index of every timestep in the precomputed schedule, or None if one of them is not scheduled
+    (e.g. intermediate timesteps of second order samplers).
+    """
+    match = schedule_timesteps[None, :] == timesteps[:, None].to(schedule_timesteps)
+    if not bool(match.any(dim=1).all()):
+        return None
+    return match.int().argmax(dim=1)
+
+def flux_schedule_vec(self, timesteps, guidance, y, transformer_options, dtype, time_factor=1000.0):
+    """
+    vec and the first double block img_mod of the current step for FLUX/HunyuanVideo.
+
+    The time/guidance/vector embeddings and img_mod are computed for every scheduled timestep in a
+    single batched pass at the first step of a run and kept in the run, shared by its sub-step
+    slots. There is one schedule per batch layout (cond_or_uncond and batch size), so branches
+    evaluated in separate calls do not rebuild each other's. A schedule is rebuilt when the sigmas,
+    y or guidance change and bypassed when a timestep is not in it.
+    """
+    def compute(t, g, y_rows):
+        vec = self.time_in(timestep_embedding(t, 256, time_factor=time_factor).to(dtype))
+        if self.params.guidance_embed and g is not None:
+            vec = vec + self.guidance_in(timestep_embedding(g, 256).to(dtype))
+        vec = vec + self.vector_in(y_rows[:, :self.params.vec_in_dim])
+        img_mod1, _ = self.double_blocks[0].img_mod(vec)
+        return vec, img_mod1
+
+    sample_sigmas = transformer_options.get("sample_sigmas")
+    sample_timesteps = transformer_options.get("sample_timesteps")
+    if sample_timesteps is None:
+        return compute(timesteps, guidance, y)
+
+    b = timesteps.shape[0]
+    run = get_teacache_run(self, transformer_options)
+    schedule_key = (tuple(transformer_options.get("cond_or_uncond", [])), b)
+    schedules = run.setdefault('schedules', {})
+    schedule = schedules.get(schedule_key)
+    # same_input only compares the values when y/guidance are not the tensors the schedule was built from
+    if (schedule is None or schedule['sigmas'] is not sample_sigmas
+            or not same_input(schedule['y'], schedule['y_version'], y)
+            or not same_input(schedule['guidance'], schedule['guidance_version'], guidance)):
+        # the last sigma is the end of sampling, the model is never evaluated there
+        schedule_timesteps = sample_timesteps[:-1].to(device=timesteps.device, dtype=timesteps.dtype)
+        n = len(schedule_timesteps)
+        vec, img_mod1 = compute(
+            schedule_timesteps.repeat_interleave(b),
+            guidance.repeat(n) if guidance is not None else None,
+            y.repeat(n, 1),
+        )
+        schedule = {
+            'sigmas': sample_sigmas,
+            'y': y,
+            'y_version': y._version,
+            'guidance': guidance,
+            'guidance_version': guidance._version if guidance is not None else None,
+            'timesteps': schedule_timesteps,
+            'vec': vec.unflatten(0, (n, b)),
+            'shift': img_mod1.shift.unflatten(0, (n, b)),
+            'scale': img_mod1.scale.unflatten(0, (n, b)),
+            'gate': img_mod1.gate.unflatten(0, (n, b)),
+        }
+        schedules[schedule_key] = schedule
+
+    index = schedule_step_index(schedule['timesteps'], timesteps[:1])
+    if index is None or not bool((timesteps == timesteps[0]).all()):
+        return compute(timesteps, guidance, y)
+    step = index[0]
+    return schedule['vec'][step], ModulationOut(shift=schedule['shift'][step], scale=schedule['scale'][step], gate=schedule['gate'][step])
+
+CHROMA_MOD_INDEX_LENGTH = 344
+
+def chroma_modulation_index(self, device, dtype):
+    # constant part of the chroma modulation input, only depends on device/dtype
+    if not hasattr(self, 'teacache_modulation_index'):
+        self.teacache_modulation_index = {}
+    key = (device, dtype)
+    if key not in self.teacache_modulation_index:
+        self.teacache_modulation_index[key] = timestep_embedding(torch.arange(CHROMA_MOD_INDEX_LENGTH, device=device), 32).to(device, dtype)
+    return self.teacache_modulation_index[key]
+
+def chroma_compute_mod_vectors(self, timesteps, guidance, device, dtype):
+    distill_timestep = timestep_embedding(timesteps.detach().clone(), 16).to(device, dtype)
+    distil_guidance = timestep_embedding(guidance.detach().clone(), 16).to(device, dtype)
+    modulation_index = chroma_modulation_index(self, device, dtype).unsqueeze(0).repeat(timesteps.shape[0], 1, 1)
+    timestep_guidance = torch.cat([distill_timestep, distil_guidance], dim=1).unsqueeze(1).repeat(1, CHROMA_MOD_INDEX_LENGTH, 1)
+    input_vec = torch.cat([timestep_guidance, modulation_index], dim=-1)
+    return self.distilled_guidance_layer(input_vec)
+
+def chroma_mod_vectors(self, timesteps, guidance, transformer_options, device, dtype):
+    """
+    Modulation vectors of the current step. The vectors for every scheduled timestep are computed
+    in a single batched pass at the first step of a run and looked up afterwards.
+    """
+    sample_sigmas = transformer_options.get("sample_sigmas")
+    sample_timesteps = transformer_options.get("sample_timesteps")
+    if sample_timesteps is None:
+        return chroma_compute_mod_vectors(self, timesteps, guidance, device, dtype)
+
+    run = get_teacache_run(self, transformer_options)
+    # the conditioning is fixed during a run, read the guidance once per batch layout instead of every step
+    guidance_key = (tuple(transformer_options.get("cond_or_uncond", [])), tuple(guidance.shape))
+    guidance_values = run.setdefault('mod_guidance', {})
+    if guidance_key not in guidance_values:
+        guidance_values[guidance_key] = guidance[0].item() if bool((guidance == guidance[0]).all()) else None
+    guidance_value = guidance_values[guidance_key]
+    if guidance_value is None:
+        return chroma_compute_mod_vectors(self, timesteps, guidance, device, dtype)
+
+    schedule = run.get('mod_schedule')
+    if (schedule is None or schedule['sigmas'] is not sample_sigmas or schedule['guidance'] != guidance_value
+            or schedule['device'] != device or schedule['dtype'] != dtype):
+        # the last sigma is the end of sampling, the model is never evaluated there
+        schedule_timesteps = sample_timesteps[:-1].to(device=device, dtype=timesteps.dtype)
+        schedule = {
+            'sigmas': sample_sigmas,
+            'guidance': guidance_value,
+            'device': device,
+            'dtype': dtype,
+            'timesteps': schedule_timesteps,
+            'mod_vectors': chroma_compute_mod_vectors(self, schedule_timesteps, guidance[:1].expand(len(schedule_timesteps)), device, dtype),
+        }
+        run['mod_schedule'] = schedule
+
+    index = schedule_step_index(schedule['timesteps'], timesteps)
+    if index is None:
+        return chroma_compute_mod_vectors(self, timesteps, guidance, device, dtype)
+    return schedule['mod_vectors'][index]
+
 def teacache_chroma_forward(
     self,
     img: torch.Tensor,
@@ -56,6 +433,11 @@ def teacache_chroma_forward(
     cond_or_uncond = transformer_options.get("cond_or_uncond", [0])
     current_percent = transformer_options.get("current_percent", None)
     debug_teacache = transformer_options.get("debug_teacache", False)
+    skip_signal = transformer_options.get("skip_signal", "modulated_input")
+    uncond_reuse = transformer_options.get("uncond_reuse", "disabled")
+    if uncond_reuse == "freq_delta":
+        # the output is still in token space here, fall back to the plain difference
+        uncond_reuse = "delta"
 
     if img.ndim != 3 or txt.ndim != 3:
         raise ValueError("Input img and txt tensors must have 3 dimensions.")
@@ -63,45 +445,34 @@ def teacache_chroma_forward(
     if not hasattr(self, 'teacache_data_collection'):
         self.teacache_data_collection = {'input_changes': [], 'output_changes': []}
 
-    if not hasattr(self, 'teacache_state'):
-        self.teacache_state = {
-            0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_output': None},
-            1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_output': None},
-        }
+    teacache_state = get_teacache_state(self, transformer_options, lambda: {
+        0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_output': None},
+        1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_output': None, 'uncond_delta': None},
+    })
 
     img = self.img_in(img)
-    mod_index_length = 344
-    distill_timestep = timestep_embedding(timesteps.detach().clone(), 16).to(img.device, img.dtype)
-    distil_guidance = timestep_embedding(guidance.detach().clone(), 16).to(img.device, img.dtype)
-    modulation_index = timestep_embedding(torch.arange(mod_index_length, device=img.device), 32).to(img.device, img.dtype)
-    modulation_index = modulation_index.unsqueeze(0).repeat(img.shape[0], 1, 1).to(img.device, img.dtype)
-    timestep_guidance = torch.cat([distill_timestep, distil_guidance], dim=1).unsqueeze(1).repeat(1, mod_index_length, 1).to(img.dtype).to(img.device, img.dtype)
-    input_vec = torch.cat([timestep_guidance, modulation_index], dim=-1).to(img.device, img.dtype)
-    mod_vectors = self.distilled_guidance_layer(input_vec)
-    txt = self.txt_in(txt)
-    ids = torch.cat((txt_ids, img_ids), dim=1)
-    pe = self.pe_embedder(ids)
+    mod_vectors = chroma_mod_vectors(self, timesteps, guidance, transformer_options, img.device, img.dtype)
     blocks_replace = patches_replace.get("dit", {})
 
     double_mod_img, _ = self.get_modulations(mod_vectors, "double_img", idx=0)
-    modulated_inp = self.double_blocks[0].img_norm1(img)
-    modulated_inp = apply_mod(modulated_inp, (1 + double_mod_img.scale), double_mod_img.shift)
+    modulated_inputs = []
+    def modulated_input():
+        # only built when the skip signal needs the image tokens
+        if not modulated_inputs:
+            modulated_inp = self.double_blocks[0].img_norm1(img)
+            modulated_inputs.append(apply_mod(modulated_inp, (1 + double_mod_img.scale), double_mod_img.shift))
+        return modulated_inputs[0]
 
     b = int(img.shape[0] / len(cond_or_uncond))
     input_changes_this_step = {}
     for i, k in enumerate(cond_or_uncond):
-        cache = self.teacache_state[k]
-        mod_inp = modulated_inp[i*b:(i+1)*b]
-        if debug_teacache and cache['previous_modulated_input'] is not None:
-            input_change = ((mod_inp - cache['previous_modulated_input']).abs().mean() /
-                            (cache['previous_modulated_input'].abs().mean() + 1e-8)).item()
-            input_changes_this_step[k] = input_change
-        else:
-            input_changes_this_step[k] = None
-        if cache['previous_modulated_input'] is not None:
+        cache = teacache_state[k]
+        branch_mod = ModulationOut(shift=double_mod_img.shift[i*b:(i+1)*b], scale=double_mod_img.scale[i*b:(i+1)*b], gate=None)
+        input_change = skip_signal_rel_l1(cache, skip_signal, branch_mod, lambda: modulated_input()[i*b:(i+1)*b])
+        input_changes_this_step[k] = input_change.item() if debug_teacache and input_change is not None else None
+        if input_change is not None:
             try:
-                cache['accumulated_rel_l1_distance'] += poly1d(coefficients, ((mod_inp - cache['previous_modulated_input']).abs().mean() /
-                                                                              (cache['previous_modulated_input'].abs().mean() + 1e-8)))
+                cache['accumulated_rel_l1_distance'] += poly1d(coefficients, input_change)
                 if cache['accumulated_rel_l1_distance'] < rel_l1_thresh:
                     cache['should_calc'] = False
                 else:
@@ -113,18 +484,26 @@ def teacache_chroma_forward(
         else:
             cache['should_calc'] = True
             cache['accumulated_rel_l1_distance'] = 0
-        cache['previous_modulated_input'] = mod_inp
 
     text_len = txt.shape[1]
 
     if not enable_teacache:
         should_calc = True
     else:
-        should_calc = any(self.teacache_state[k]['should_calc'] for k in cond_or_uncond)
+        should_calc = any(teacache_state[k]['should_calc'] for k in cond_or_uncond)
+
+    uncond_shortcut = control is None and use_uncond_shortcut(teacache_state, cond_or_uncond, enable_teacache, uncond_reuse)
+    computed = cond_or_uncond
+    if uncond_shortcut:
+        # compute cond alone, uncond is rebuilt from the cached difference after the final layer
+        i_c = cond_or_uncond.index(0)
+        img, txt, txt_ids, img_ids, mod_vectors, attn_mask = take_rows((img, txt, txt_ids, img_ids, mod_vectors, attn_mask), slice(i_c*b, (i_c+1)*b))
+        computed = [0]
+        transformer_options = {**transformer_options, "cond_or_uncond": computed}
 
     if not should_calc:
         for i, k in enumerate(cond_or_uncond):
-            cache = self.teacache_state[k]
+            cache = teacache_state[k]
             if debug_teacache:
                 print(
                     f"[TeaCache] step (timestep={timesteps[i*b].item()} group={k}): "
@@ -137,6 +516,9 @@ def teacache_chroma_forward(
                 cache['should_calc'] = True
                 should_calc = True
     if should_calc:
+        # only needed by the blocks
+        txt = cached_projection(get_teacache_run(self, transformer_options), ("txt_in", tuple(computed)), self.txt_in, txt)
+        pe = cached_projection(get_teacache_run(self, transformer_options), ("pe", tuple(computed)), self.pe_embedder, torch.cat((txt_ids, img_ids), dim=1))
         ori_img = img.clone()
         for i, block in enumerate(self.double_blocks):
             if i not in self.skip_mmdit:
@@ -157,7 +539,7 @@ def teacache_chroma_forward(
                         return out
                     out = blocks_replace[("double_block", i)](
                         {"img": img, "txt": txt, "vec": double_mod, "pe": pe, "attn_mask": attn_mask},
-                        {"original_block": block_wrap}
+                        {"original_block": block_wrap, "transformer_options": transformer_options}
                     )
                     txt = out["txt"]
                     img = out["img"]
@@ -185,7 +567,7 @@ def teacache_chroma_forward(
                         return out
                     out = blocks_replace[("single_block", i)](
                         {"img": img, "vec": single_mod, "pe": pe, "attn_mask": attn_mask},
-                        {"original_block": block_wrap}
+                        {"original_block": block_wrap, "transformer_options": transformer_options}
                     )
                     img = out["img"]
                 else:
@@ -197,8 +579,8 @@ def teacache_chroma_forward(
                     if add is not None:
                         img[:, text_len:, ...] += add
         img = img[:, text_len:, ...]
-        for i, k in enumerate(cond_or_uncond):
-            cache = self.teacache_state[k]
+        for i, k in enumerate(computed):
+            cache = teacache_state[k]
             current_output = img[i*b:(i+1)*b].detach().clone()
             if (
                 debug_teacache
@@ -217,6 +599,11 @@ def teacache_chroma_forward(
     final_mod = self.get_modulations(mod_vectors, "final")
     img = self.final_layer(img, vec=final_mod)
 
+    if uncond_shortcut:
+        img = reconstruct_uncond(teacache_state, cond_or_uncond, img)
+    elif should_calc:
+        update_uncond_delta(teacache_state, cond_or_uncond, img, uncond_reuse)
+
     if debug_teacache and current_percent is not None and current_percent >= 0.95:
         import numpy as np
         x = np.array(self.teacache_data_collection['input_changes'])
@@ -247,58 +634,56 @@ def teacache_flux_forward(
         rel_l1_thresh = transformer_options.get("rel_l1_thresh")
         coefficients = transformer_options.get("coefficients")
         enable_teacache = transformer_options.get("enable_teacache", True)
+        skip_signal = transformer_options.get("skip_signal", "modulated_input")
         
         if img.ndim != 3 or txt.ndim != 3:
             raise ValueError("Input img and txt tensors must have 3 dimensions.")
 
+        state = get_teacache_state(self, transformer_options, lambda: {'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None})
+
         # running on sequences img
         img = self.img_in(img)
-        vec = self.time_in(timestep_embedding(timesteps, 256).to(img.dtype))
-        if self.params.guidance_embed:
-            if guidance is None:
-                raise ValueError("Didn't get guidance strength for guidance distilled model.")
-            vec = vec + self.guidance_in(timestep_embedding(guidance, 256).to(img.dtype))
-
-        vec = vec + self.vector_in(y[:,:self.params.vec_in_dim])
-        txt = self.txt_in(txt)
-
-        if img_ids is not None:
-            ids = torch.cat((txt_ids, img_ids), dim=1)
-            pe = self.pe_embedder(ids)
-        else:
-            pe = None
+        if self.params.guidance_embed and guidance is None:
+            raise ValueError("Didn't get guidance strength for guidance distilled model.")
+        vec, img_mod1 = flux_schedule_vec(self, timesteps, guidance, y, transformer_options, img.dtype)
 
         blocks_replace = patches_replace.get("dit", {})
 
         # enable teacache
-        img_mod1, _ = self.double_blocks[0].img_mod(vec)
-        modulated_inp = self.double_blocks[0].img_norm1(img)
-        modulated_inp = apply_mod(modulated_inp, (1 + img_mod1.scale), img_mod1.shift)
+        input_change = skip_signal_rel_l1(
+            state, skip_signal, img_mod1,
+            lambda: apply_mod(self.double_blocks[0].img_norm1(img), (1 + img_mod1.scale), img_mod1.shift),
+        )
         ca_idx = 0
 
-        if not hasattr(self, 'accumulated_rel_l1_distance'):
+        if input_change is None or state['previous_residual'] is None:
             should_calc = True
-            self.accumulated_rel_l1_distance = 0
+            state['accumulated_rel_l1_distance'] = 0
         else:
             try:
-                self.accumulated_rel_l1_distance += poly1d(coefficients, ((modulated_inp-self.previous_modulated_input).abs().mean() / self.previous_modulated_input.abs().mean()))
-                if self.accumulated_rel_l1_distance < rel_l1_thresh:
+                state['accumulated_rel_l1_distance'] += poly1d(coefficients, input_change)
+                if state['accumulated_rel_l1_distance'] < rel_l1_thresh:
                     should_calc = False
                 else:
                     should_calc = True
-                    self.accumulated_rel_l1_distance = 0
+                    state['accumulated_rel_l1_distance'] = 0
             except:
                 should_calc = True
-                self.accumulated_rel_l1_distance = 0
-
-        self.previous_modulated_input = modulated_inp
+                state['accumulated_rel_l1_distance'] = 0
 
         if not enable_teacache:
             should_calc = True
 
         if not should_calc:
-            img += self.previous_residual.to(img.device)
+            img += state['previous_residual'].to(img.device)
         else:
+            # only needed by the blocks
+            txt = cached_projection(get_teacache_run(self, transformer_options), ("txt_in",), self.txt_in, txt)
+            if img_ids is not None:
+                pe = cached_projection(get_teacache_run(self, transformer_options), ("pe",), self.pe_embedder, torch.cat((txt_ids, img_ids), dim=1))
+            else:
+                pe = None
+
             ori_img = img.clone()
             for i, block in enumerate(self.double_blocks):
                 if ("double_block", i) in blocks_replace:
@@ -316,7 +701,7 @@ def teacache_flux_forward(
                                                             "vec": vec,
                                                             "pe": pe,
                                                             "attn_mask": attn_mask},
-                                                            {"original_block": block_wrap})
+                                                            {"original_block": block_wrap, "transformer_options": transformer_options})
                     txt = out["txt"]
                     img = out["img"]
                 else:
@@ -358,8 +743,8 @@ def teacache_flux_forward(
                     out = blocks_replace[("single_block", i)]({"img": img,
                                                             "vec": vec,
                                                             "pe": pe,
-                                                            "attn_mask": attn_mask}, 
-                                                            {"original_block": block_wrap})
+                                                            "attn_mask": attn_mask},
+                                                            {"original_block": block_wrap, "transformer_options": transformer_options})
                     img = out["img"]
                 else:
                     img = block(img, vec=vec, pe=pe, attn_mask=attn_mask)
@@ -384,7 +769,7 @@ def teacache_flux_forward(
                     img = torch.cat((txt, real_img), 1)
 
             img = img[:, txt.shape[1] :, ...]
-            self.previous_residual = (img - ori_img).to(mm.unet_offload_device())
+            state['previous_residual'] = (img - ori_img).to(mm.unet_offload_device())
 
         img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
         
@@ -405,6 +790,8 @@ def teacache_hidream_forward(
         coefficients = transformer_options.get("coefficients")
         cond_or_uncond = transformer_options.get("cond_or_uncond")
         enable_teacache = transformer_options.get("enable_teacache", True)
+        uncond_reuse = transformer_options.get("uncond_reuse", "disabled")
+        current_percent = transformer_options.get("current_percent", 0.0)
 
         bs, c, h, w = x.shape
         if image_cond is not None:
@@ -415,6 +802,7 @@ def teacache_hidream_forward(
         T5_encoder_hidden_states = context
 
         img_sizes = None
+        img_ids = None
 
         # spatial forward
         batch_size = hidden_states.shape[0]
@@ -435,37 +823,41 @@ def teacache_hidream_forward(
             img_ids = repeat(img_ids, "h w c -> b (h w) c", b=batch_size)
         hidden_states = self.x_embedder(hidden_states)
 
-        # T5_encoder_hidden_states = encoder_hidden_states[0]
-        encoder_hidden_states = encoder_hidden_states_llama3.movedim(1, 0)
-        encoder_hidden_states = [encoder_hidden_states[k] for k in self.llama_layers]
-
-        if self.caption_projection is not None:
-            new_encoder_hidden_states = []
-            for i, enc_hidden_state in enumerate(encoder_hidden_states):
-                enc_hidden_state = self.caption_projection[i](enc_hidden_state)
-                enc_hidden_state = enc_hidden_state.view(batch_size, -1, hidden_states.shape[-1])
-                new_encoder_hidden_states.append(enc_hidden_state)
-            encoder_hidden_states = new_encoder_hidden_states
-            T5_encoder_hidden_states = self.caption_projection[-1](T5_encoder_hidden_states)
-            T5_encoder_hidden_states = T5_encoder_hidden_states.view(batch_size, -1, hidden_states.shape[-1])
-            encoder_hidden_states.append(T5_encoder_hidden_states)
-
-        txt_ids = torch.zeros(
-            batch_size,
-            encoder_hidden_states[-1].shape[1] + encoder_hidden_states[-2].shape[1] + encoder_hidden_states[0].shape[1],
-            3,
-            device=img_ids.device, dtype=img_ids.dtype
-        )
-        ids = torch.cat((img_ids, txt_ids), dim=1)
-        rope = self.pe_embedder(ids)
+        inner_dim = hidden_states.shape[-1]
+        def embed_context(encoder_hidden_states_llama3, T5_encoder_hidden_states, img_ids):
+            # only needed by the blocks
+            batch_size = encoder_hidden_states_llama3.shape[0]
+            # T5_encoder_hidden_states = encoder_hidden_states[0]
+            encoder_hidden_states = encoder_hidden_states_llama3.movedim(1, 0)
+            encoder_hidden_states = [encoder_hidden_states[k] for k in self.llama_layers]
+
+            if self.caption_projection is not None:
+                new_encoder_hidden_states = []
+                for i, enc_hidden_state in enumerate(encoder_hidden_states):
+                    enc_hidden_state = self.caption_projection[i](enc_hidden_state)
+                    enc_hidden_state = enc_hidden_state.view(batch_size, -1, inner_dim)
+                    new_encoder_hidden_states.append(enc_hidden_state)
+                encoder_hidden_states = new_encoder_hidden_states
+                T5_encoder_hidden_states = self.caption_projection[-1](T5_encoder_hidden_states)
+                T5_encoder_hidden_states = T5_encoder_hidden_states.view(batch_size, -1, inner_dim)
+                encoder_hidden_states.append(T5_encoder_hidden_states)
+
+            txt_ids = torch.zeros(
+                batch_size,
+                encoder_hidden_states[-1].shape[1] + encoder_hidden_states[-2].shape[1] + encoder_hidden_states[0].shape[1],
+                3,
+                device=img_ids.device, dtype=img_ids.dtype
+            )
+            ids = torch.cat((img_ids, txt_ids), dim=1)
+            rope = self.pe_embedder(ids)
+            return encoder_hidden_states, rope
 
         # enable teacache
         modulated_inp = timesteps.to(mm.unet_offload_device())
-        if not hasattr(self, 'teacache_state'):
-            self.teacache_state = {
-                0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None},
-                1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None}
-            }
+        teacache_state = get_teacache_state(self, transformer_options, lambda: {
+            0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None},
+            1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None, 'uncond_delta': None}
+        })
 
         def update_cache_state(cache, modulated_inp):
             if cache['previous_modulated_input'] is not None:
@@ -484,19 +876,35 @@ def teacache_hidream_forward(
         b = int(len(hidden_states) / len(cond_or_uncond))
 
         for i, k in enumerate(cond_or_uncond):
-            update_cache_state(self.teacache_state[k], modulated_inp[i*b:(i+1)*b])
+            update_cache_state(teacache_state[k], modulated_inp[i*b:(i+1)*b])
 
         if enable_teacache:
             should_calc = False
             for k in cond_or_uncond:
-                should_calc = (should_calc or self.teacache_state[k]['should_calc'])
+                should_calc = (should_calc or teacache_state[k]['should_calc'])
         else:
             should_calc = True
 
+        # ControlNet residuals are computed for the full batch, the rows cannot be sliced
+        uncond_shortcut = control is None and use_uncond_shortcut(teacache_state, cond_or_uncond, enable_teacache, uncond_reuse)
+        computed = cond_or_uncond
+        if uncond_shortcut:
+            # compute cond alone, uncond is rebuilt from the cached difference after unpatchify
+            i_c = cond_or_uncond.index(0)
+            rows = slice(i_c*b, (i_c+1)*b)
+            hidden_states, image_tokens_masks, encoder_hidden_states_llama3, T5_encoder_hidden_states, img_ids, adaln_input = take_rows(
+                (hidden_states, image_tokens_masks, encoder_hidden_states_llama3, T5_encoder_hidden_states, img_ids, adaln_input), rows)
+            img_sizes = img_sizes[rows]
+            batch_size = b
+            computed = [0]
+
         if not should_calc:
             for i, k in enumerate(cond_or_uncond):
-                hidden_states[i*b:(i+1)*b] += self.teacache_state[k]['previous_residual'].to(hidden_states.device)
+                hidden_states[i*b:(i+1)*b] += teacache_state[k]['previous_residual'].to(hidden_states.device)
         else:
+            encoder_hidden_states, rope = cached_projection(
+                get_teacache_run(self, transformer_options), ("context", tuple(computed)), embed_context, encoder_hidden_states_llama3, T5_encoder_hidden_states, img_ids)
+
             # 2. Blocks
             ori_hidden_states = hidden_states.clone()
             block_id = 0
@@ -539,12 +947,18 @@ def teacache_hidream_forward(
                 block_id += 1
 
             hidden_states = hidden_states[:, :image_tokens_seq_len, ...]
-            for i, k in enumerate(cond_or_uncond):
-                self.teacache_state[k]['previous_residual'] = (hidden_states - ori_hidden_states)[i*b:(i+1)*b].to(mm.unet_offload_device())
+            for i, k in enumerate(computed):
+                teacache_state[k]['previous_residual'] = (hidden_states - ori_hidden_states)[i*b:(i+1)*b].to(mm.unet_offload_device())
 
         output = self.final_layer(hidden_states, adaln_input)
         output = self.unpatchify(output, img_sizes)
-        return -output[:, :, :h, :w]    
+        output = -output[:, :, :h, :w]
+
+        if uncond_shortcut:
+            output = reconstruct_uncond(teacache_state, cond_or_uncond, output, current_percent)
+        elif should_calc:
+            update_uncond_delta(teacache_state, cond_or_uncond, output, uncond_reuse)
+        return output
 
 def teacache_hunyuanvideo_forward(
         self,
@@ -565,11 +979,13 @@ def teacache_hunyuanvideo_forward(
         rel_l1_thresh = transformer_options.get("rel_l1_thresh")
         coefficients = transformer_options.get("coefficients")
         enable_teacache = transformer_options.get("enable_teacache", True)
+        skip_signal = transformer_options.get("skip_signal", "modulated_input")
+
+        state = get_teacache_state(self, transformer_options, lambda: {'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None})
 
         initial_shape = list(img.shape)
         # running on sequences img
         img = self.img_in(img)
-        vec = self.time_in(timestep_embedding(timesteps, 256, time_factor=1.0).to(img.dtype))
 
         if ref_latent is not None:
             ref_latent_ids = self.img_ids(ref_latent)
@@ -580,67 +996,68 @@ def teacache_hunyuanvideo_forward(
             img_ids = torch.cat([ref_latent_ids, img_ids], dim=-2)
 
         if guiding_frame_index is not None:
+            vec = self.time_in(timestep_embedding(timesteps, 256, time_factor=1.0).to(img.dtype))
             token_replace_vec = self.time_in(timestep_embedding(guiding_frame_index, 256, time_factor=1.0))
             vec_ = self.vector_in(y[:, :self.params.vec_in_dim])
             vec = torch.cat([(vec_ + token_replace_vec).unsqueeze(1), (vec_ + vec).unsqueeze(1)], dim=1)
             frame_tokens = (initial_shape[-1] // self.patch_size[-1]) * (initial_shape[-2] // self.patch_size[-2])
             modulation_dims = [(0, frame_tokens, 0), (frame_tokens, None, 1)]
             modulation_dims_txt = [(0, None, 1)]
+            if self.params.guidance_embed:
+                if guidance is not None:
+                    vec = vec + self.guidance_in(timestep_embedding(guidance, 256).to(img.dtype))
+            img_mod1, _ = self.double_blocks[0].img_mod(vec)
         else:
-            vec = vec + self.vector_in(y[:, :self.params.vec_in_dim])
+            vec, img_mod1 = flux_schedule_vec(self, timesteps, guidance, y, transformer_options, img.dtype, time_factor=1.0)
             modulation_dims = None
             modulation_dims_txt = None
 
-        if self.params.guidance_embed:
-            if guidance is not None:
-                vec = vec + self.guidance_in(timestep_embedding(guidance, 256).to(img.dtype))
-
-        if txt_mask is not None and not torch.is_floating_point(txt_mask):
-            txt_mask = (txt_mask - 1).to(img.dtype) * torch.finfo(img.dtype).max
-
-        txt = self.txt_in(txt, timesteps, txt_mask)
-
-        ids = torch.cat((img_ids, txt_ids), dim=1)
-        pe = self.pe_embedder(ids)
-
         img_len = img.shape[1]
-        if txt_mask is not None:
-            attn_mask_len = img_len + txt.shape[1]
-            attn_mask = torch.zeros((1, 1, attn_mask_len), dtype=img.dtype, device=img.device)
-            attn_mask[:, 0, img_len:] = txt_mask
-        else:
-            attn_mask = None
 
         blocks_replace = patches_replace.get("dit", {})
 
         # enable teacache
-        img_mod1, _ = self.double_blocks[0].img_mod(vec)
-        modulated_inp = self.double_blocks[0].img_norm1(img)
-        modulated_inp = apply_mod(modulated_inp, (1 + img_mod1.scale), img_mod1.shift, modulation_dims)
+        input_change = skip_signal_rel_l1(
+            state, skip_signal, img_mod1,
+            lambda: apply_mod(self.double_blocks[0].img_norm1(img), (1 + img_mod1.scale), img_mod1.shift, modulation_dims),
+        )
 
-        if not hasattr(self, 'accumulated_rel_l1_distance'):
+        if input_change is None or state['previous_residual'] is None:
             should_calc = True
-            self.accumulated_rel_l1_distance = 0
+            state['accumulated_rel_l1_distance'] = 0
         else:
             try:
-                self.accumulated_rel_l1_distance += poly1d(coefficients, ((modulated_inp-self.previous_modulated_input).abs().mean() / self.previous_modulated_input.abs().mean()))
-                if self.accumulated_rel_l1_distance < rel_l1_thresh:
+                state['accumulated_rel_l1_distance'] += poly1d(coefficients, input_change)
+                if state['accumulated_rel_l1_distance'] < rel_l1_thresh:
                     should_calc = False
                 else:
                     should_calc = True
-                    self.accumulated_rel_l1_distance = 0
+                    state['accumulated_rel_l1_distance'] = 0
             except:
                 should_calc = True
-                self.accumulated_rel_l1_distance = 0
-
-        self.previous_modulated_input = modulated_inp
+                state['accumulated_rel_l1_distance'] = 0
 
         if not enable_teacache:
             should_calc = True
 
         if not should_calc:
-            img += self.previous_residual.to(img.device)
+            img += state['previous_residual'].to(img.device)
         else:
+            # only needed by the blocks
+            if txt_mask is not None and not torch.is_floating_point(txt_mask):
+                txt_mask = (txt_mask - 1).to(img.dtype) * torch.finfo(img.dtype).max
+
+            # the token refiner depends on the timestep, so it is not cached across steps
+            txt = self.txt_in(txt, timesteps, txt_mask)
+            pe = cached_projection(get_teacache_run(self, transformer_options), ("pe",), self.pe_embedder, torch.cat((img_ids, txt_ids), dim=1))
+
+            if txt_mask is not None:
+                attn_mask_len = img_len + txt.shape[1]
+                attn_mask = torch.zeros((1, 1, attn_mask_len), dtype=img.dtype, device=img.device)
+                attn_mask[:, 0, img_len:] = txt_mask
+            else:
+                attn_mask = None
+
             ori_img = img.clone()
             for i, block in enumerate(self.double_blocks):
                 if ("double_block", i) in blocks_replace:
@@ -649,7 +1066,7 @@ def teacache_hunyuanvideo_forward(
                         out["img"], out["txt"] = block(img=args["img"], txt=args["txt"], vec=args["vec"], pe=args["pe"], attn_mask=args["attention_mask"], modulation_dims_img=args["modulation_dims_img"], modulation_dims_txt=args["modulation_dims_txt"])
                         return out
 
-                    out = blocks_replace[("double_block", i)]({"img": img, "txt": txt, "vec": vec, "pe": pe, "attention_mask": attn_mask, 'modulation_dims_img': modulation_dims, 'modulation_dims_txt': modulation_dims_txt}, {"original_block": block_wrap})
+                    out = blocks_replace[("double_block", i)]({"img": img, "txt": txt, "vec": vec, "pe": pe, "attention_mask": attn_mask, 'modulation_dims_img': modulation_dims, 'modulation_dims_txt': modulation_dims_txt}, {"original_block": block_wrap, "transformer_options": transformer_options})
                     txt = out["txt"]
                     img = out["img"]
                 else:
@@ -671,7 +1088,7 @@ def teacache_hunyuanvideo_forward(
                         out["img"] = block(args["img"], vec=args["vec"], pe=args["pe"], attn_mask=args["attention_mask"], modulation_dims=args["modulation_dims"])
                         return out
 
-                    out = blocks_replace[("single_block", i)]({"img": img, "vec": vec, "pe": pe, "attention_mask": attn_mask, 'modulation_dims': modulation_dims}, {"original_block": block_wrap})
+                    out = blocks_replace[("single_block", i)]({"img": img, "vec": vec, "pe": pe, "attention_mask": attn_mask, 'modulation_dims': modulation_dims}, {"original_block": block_wrap, "transformer_options": transformer_options})
                     img = out["img"]
                 else:
                     img = block(img, vec=vec, pe=pe, attn_mask=attn_mask, modulation_dims=modulation_dims)
@@ -684,7 +1101,7 @@ def teacache_hunyuanvideo_forward(
                             img[:, : img_len] += add
 
             img = img[:, : img_len]
-            self.previous_residual = (img - ori_img).to(mm.unet_offload_device())
+            state['previous_residual'] = (img - ori_img).to(mm.unet_offload_device())
 
         if ref_latent is not None:
             img = img[:, ref_latent.shape[1]:]
@@ -715,6 +1132,8 @@ def teacache_ltxvmodel_forward(
         coefficients = transformer_options.get("coefficients")
         cond_or_uncond = transformer_options.get("cond_or_uncond")
         enable_teacache = transformer_options.get("enable_teacache", True)
+        uncond_reuse = transformer_options.get("uncond_reuse", "disabled")
+        current_percent = transformer_options.get("current_percent", 0.0)
 
         orig_shape = list(x.shape)
 
@@ -737,8 +1156,6 @@ def teacache_ltxvmodel_forward(
         if attention_mask is not None and not torch.is_floating_point(attention_mask):
             attention_mask = (attention_mask - 1).to(x.dtype).reshape((attention_mask.shape[0], 1, -1, attention_mask.shape[-1])) * torch.finfo(x.dtype).max        
 
-        pe = precompute_freqs_cis(fractional_coords, dim=self.inner_dim, out_dtype=x.dtype)
-
         batch_size = x.shape[0]
         timestep, embedded_timestep = self.adaln_single(
             timestep.flatten(),
@@ -752,14 +1169,6 @@ def teacache_ltxvmodel_forward(
             batch_size, -1, embedded_timestep.shape[-1]
         )
 
-        # 2. Blocks
-        if self.caption_projection is not None:
-            batch_size = x.shape[0]
-            context = self.caption_projection(context)
-            context = context.view(
-                batch_size, -1, x.shape[-1]
-            )
-
         blocks_replace = patches_replace.get("dit", {})
 
         # enable teacache
@@ -771,11 +1180,10 @@ def teacache_ltxvmodel_forward(
         modulated_inp = comfy.ldm.common_dit.rms_norm(inp)
         modulated_inp = modulated_inp * (1 + scale_msa) + shift_msa
 
-        if not hasattr(self, 'teacache_state'):
-            self.teacache_state = {
-                0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None},
-                1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None}
-            }
+        teacache_state = get_teacache_state(self, transformer_options, lambda: {
+            0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None},
+            1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None, 'uncond_delta': None}
+        })
 
         def update_cache_state(cache, modulated_inp):
             if cache['previous_modulated_input'] is not None:
@@ -794,19 +1202,39 @@ def teacache_ltxvmodel_forward(
         b = int(len(x) / len(cond_or_uncond))
         
         for i, k in enumerate(cond_or_uncond):
-            update_cache_state(self.teacache_state[k], modulated_inp[i*b:(i+1)*b])
+            update_cache_state(teacache_state[k], modulated_inp[i*b:(i+1)*b])
 
         if enable_teacache:
             should_calc = False
             for k in cond_or_uncond:
-                should_calc = (should_calc or self.teacache_state[k]['should_calc'])
+                should_calc = (should_calc or teacache_state[k]['should_calc'])
         else:
             should_calc = True
-        
+
+        # ControlNet residuals are computed for the full batch, the rows cannot be sliced
+        uncond_shortcut = kwargs.get("control") is None and use_uncond_shortcut(teacache_state, cond_or_uncond, enable_teacache, uncond_reuse)
+        computed = cond_or_uncond
+        if uncond_shortcut:
+            # compute cond alone, uncond is rebuilt from the cached difference after unpatchify
+            i_c = cond_or_uncond.index(0)
+            x, context, attention_mask, timestep, embedded_timestep, fractional_coords = take_rows(
+                (x, context, attention_mask, timestep, embedded_timestep, fractional_coords), slice(i_c*b, (i_c+1)*b))
+            computed = [0]
+            transformer_options = {**transformer_options, "cond_or_uncond": computed}
+
         if not should_calc:
             for i, k in enumerate(cond_or_uncond):
-                x[i*b:(i+1)*b] += self.teacache_state[k]['previous_residual'].to(x.device)
+                x[i*b:(i+1)*b] += teacache_state[k]['previous_residual'].to(x.device)
         else:
+            # only needed by the blocks
+            pe = cached_projection(
+                get_teacache_run(self, transformer_options), ("pe", tuple(computed)), lambda coords: precompute_freqs_cis(coords, dim=self.inner_dim, out_dtype=x.dtype), fractional_coords)
+
+            # 2. Blocks
+            if self.caption_projection is not None:
+                context = cached_projection(
+                    get_teacache_run(self, transformer_options), ("caption_projection", tuple(computed)), lambda c: self.caption_projection(c).view(c.shape[0], -1, x.shape[-1]), context)
+
             ori_x = x.clone()
             for i, block in enumerate(self.transformer_blocks):
                 if ("double_block", i) in blocks_replace:
@@ -815,7 +1243,7 @@ def teacache_ltxvmodel_forward(
                         out["img"] = block(args["img"], context=args["txt"], attention_mask=args["attention_mask"], timestep=args["vec"], pe=args["pe"])
                         return out
 
-                    out = blocks_replace[("double_block", i)]({"img": x, "txt": context, "attention_mask": attention_mask, "vec": timestep, "pe": pe}, {"original_block": block_wrap})
+                    out = blocks_replace[("double_block", i)]({"img": x, "txt": context, "attention_mask": attention_mask, "vec": timestep, "pe": pe}, {"original_block": block_wrap, "transformer_options": transformer_options})
                     x = out["img"]
                 else:
                     x = block(
@@ -834,8 +1262,8 @@ def teacache_ltxvmodel_forward(
             x = self.norm_out(x)
             # Modulation
             x = x * (1 + scale) + shift
-            for i, k in enumerate(cond_or_uncond):
-                self.teacache_state[k]['previous_residual'] = (x - ori_x)[i*b:(i+1)*b].to(mm.unet_offload_device())
+            for i, k in enumerate(computed):
+                teacache_state[k]['previous_residual'] = (x - ori_x)[i*b:(i+1)*b].to(mm.unet_offload_device())
 
         x = self.proj_out(x)
 
@@ -847,6 +1275,10 @@ def teacache_ltxvmodel_forward(
             out_channels=orig_shape[1] // math.prod(self.patchifier.patch_size),
         )
 
+        if uncond_shortcut:
+            x = reconstruct_uncond(teacache_state, cond_or_uncond, x, current_percent)
+        elif should_calc:
+            update_uncond_delta(teacache_state, cond_or_uncond, x, uncond_reuse)
         return x
 
 def teacache_wanmodel_forward(
@@ -865,6 +1297,8 @@ def teacache_wanmodel_forward(
         cond_or_uncond = transformer_options.get("cond_or_uncond")
         use_ret_mode = transformer_options.get("use_ret_mode")
         enable_teacache = transformer_options.get("enable_teacache", True)
+        uncond_reuse = transformer_options.get("uncond_reuse", "disabled")
+        current_percent = transformer_options.get("current_percent", 0.0)
 
         # embeddings
         x = self.patch_embedding(x.float()).to(x.dtype)
@@ -876,25 +1310,18 @@ def teacache_wanmodel_forward(
             sinusoidal_embedding_1d(self.freq_dim, t).to(dtype=x[0].dtype))
         e0 = self.time_projection(e).unflatten(1, (6, self.dim))
 
-        # context
-        context = self.text_embedding(context)
-
         context_img_len = None
         if clip_fea is not None:
-            if self.img_emb is not None:
-                context_clip = self.img_emb(clip_fea)  # bs x 257 x dim
-                context = torch.concat([context_clip, context], dim=1)
             context_img_len = clip_fea.shape[-2]
 
         blocks_replace = patches_replace.get("dit", {})
 
         # enable teacache
         modulated_inp = e0.to(mm.unet_offload_device()) if use_ret_mode else e.to(mm.unet_offload_device())
-        if not hasattr(self, 'teacache_state'):
-            self.teacache_state = {
-                0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None},
-                1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None}
-            }
+        teacache_state = get_teacache_state(self, transformer_options, lambda: {
+            0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None},
+            1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None, 'uncond_delta': None}
+        })
 
         def update_cache_state(cache, modulated_inp):
             if cache['previous_modulated_input'] is not None:
@@ -913,19 +1340,35 @@ def teacache_wanmodel_forward(
         b = int(len(x) / len(cond_or_uncond))
 
         for i, k in enumerate(cond_or_uncond):
-            update_cache_state(self.teacache_state[k], modulated_inp[i*b:(i+1)*b])
+            update_cache_state(teacache_state[k], modulated_inp[i*b:(i+1)*b])
 
         if enable_teacache:
             should_calc = False
             for k in cond_or_uncond:
-                should_calc = (should_calc or self.teacache_state[k]['should_calc'])
+                should_calc = (should_calc or teacache_state[k]['should_calc'])
         else:
             should_calc = True
 
+        # ControlNet residuals are computed for the full batch, the rows cannot be sliced
+        uncond_shortcut = kwargs.get("control") is None and use_uncond_shortcut(teacache_state, cond_or_uncond, enable_teacache, uncond_reuse)
+        computed = cond_or_uncond
+        if uncond_shortcut:
+            # compute cond alone, uncond is rebuilt from the cached difference after unpatchify
+            i_c = cond_or_uncond.index(0)
+            x, e, e0, context, clip_fea = take_rows((x, e, e0, context, clip_fea), slice(i_c*b, (i_c+1)*b))
+            computed = [0]
+            transformer_options = {**transformer_options, "cond_or_uncond": computed}
+
         if not should_calc:
             for i, k in enumerate(cond_or_uncond):
-                x[i*b:(i+1)*b] += self.teacache_state[k]['previous_residual'].to(x.device)
+                x[i*b:(i+1)*b] += teacache_state[k]['previous_residual'].to(x.device)
         else:
+            # context, only needed by the blocks
+            context = cached_projection(get_teacache_run(self, transformer_options), ("text_embedding", tuple(computed)), self.text_embedding, context)
+            if clip_fea is not None and self.img_emb is not None:
+                context_clip = cached_projection(get_teacache_run(self, transformer_options), ("img_emb", tuple(computed)), self.img_emb, clip_fea)  # bs x 257 x dim
+                context = torch.concat([context_clip, context], dim=1)
+
             ori_x = x.clone()
             for i, block in enumerate(self.blocks):
                 if ("double_block", i) in blocks_replace:
@@ -933,18 +1376,23 @@ def teacache_wanmodel_forward(
                         out = {}
                         out["img"] = block(args["img"], context=args["txt"], e=args["vec"], freqs=args["pe"], context_img_len=context_img_len)
                         return out
-                    out = blocks_replace[("double_block", i)]({"img": x, "txt": context, "vec": e0, "pe": freqs}, {"original_block": block_wrap, "transformer_options": transformer_options})
+                    out = blocks_replace[("double_block", i)]({"img": x, "txt": context, "vec": e0, "pe": freqs, "context_img_len": context_img_len}, {"original_block": block_wrap, "transformer_options": transformer_options})
                     x = out["img"]
                 else:
                     x = block(x, e=e0, freqs=freqs, context=context, context_img_len=context_img_len)
-            for i, k in enumerate(cond_or_uncond):
-                self.teacache_state[k]['previous_residual'] = (x - ori_x)[i*b:(i+1)*b].to(mm.unet_offload_device())
+            for i, k in enumerate(computed):
+                teacache_state[k]['previous_residual'] = (x - ori_x)[i*b:(i+1)*b].to(mm.unet_offload_device())
 
         # head
         x = self.head(x, e)
 
         # unpatchify
         x = self.unpatchify(x, grid_sizes)
+
+        if uncond_shortcut:
+            x = reconstruct_uncond(teacache_state, cond_or_uncond, x, current_percent)
+        elif should_calc:
+            update_uncond_delta(teacache_state, cond_or_uncond, x, uncond_reuse)
         return x
 
 class TeaCache:
@@ -956,7 +1404,10 @@ class TeaCache:
                 "model_type": (["chroma", "flux", "ltxv", "hunyuan_video", "hidream_i1_full", "wan2.1_t2v_1.3B", "wan2.1_t2v_14B", "wan2.1_i2v_480p_14B", "wan2.1_i2v_720p_14B", "wan2.1_t2v_1.3B_ret_mode", "wan2.1_t2v_14B_ret_mode", "wan2.1_i2v_480p_14B_ret_mode", "wan2.1_i2v_720p_14B_ret_mode"], {"default": "chroma", "tooltip": "Supported diffusion model."}),
                 "rel_l1_thresh": ("FLOAT", {"default": 0.4, "min": 0.0, "max": 10.0, "step": 0.01, "tooltip": "How strongly to cache the output of diffusion model. This value must be non-negative."}),
                 "start_percent": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The start percentage of the steps that will apply TeaCache."}),
-                "end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The end percentage of the steps that will apply TeaCache."})
+                "end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The end percentage of the steps that will apply TeaCache."}),
+                "uncond_reuse": (["disabled", "delta", "freq_delta"], {"default": "disabled", "tooltip": "For CFG models (Wan2.1, LTX-Video, HiDream, Chroma). When only cond needs recomputation, compute cond alone and rebuild uncond from the cached cond/uncond difference. freq_delta scales the low and high frequency parts of the difference separately (FasterCache)."}),
+                "skip_signal": (["modulated_input", "modulation"], {"default": "modulated_input", "tooltip": "For FLUX, HunyuanVideo and Chroma. modulated_input measures the change of the modulated image tokens of the first block. modulation only measures the change of the modulation vector, which avoids a full-size pass on skipped steps. It is calibrated against modulated_input on the first steps of every run."}),
+                "stage_cache": (["reset", "inherit"], {"default": "reset", "tooltip": "For chained samplers (e.g. split sigmas or two KSampler Advanced), reset starts every sampling with an empty cache, inherit continues from the cache of the previous sampling when it ended at the first sigma of this one."}),
             }
         }
     
@@ -966,7 +1417,7 @@ class TeaCache:
     CATEGORY = "TeaCache"
     TITLE = "TeaCache"
     
-    def apply_teacache(self, model, model_type: str, rel_l1_thresh: float, start_percent: float, end_percent: float):
+    def apply_teacache(self, model, model_type: str, rel_l1_thresh: float, start_percent: float, end_percent: float, uncond_reuse: str = "disabled", skip_signal: str = "modulated_input", stage_cache: str = "reset"):
         if rel_l1_thresh == 0:
             return (model,)
 
@@ -976,152 +1427,744 @@ class TeaCache:
         new_model.model_options["transformer_options"]["rel_l1_thresh"] = rel_l1_thresh
         new_model.model_options["transformer_options"]["coefficients"] = SUPPORTED_MODELS_COEFFICIENTS[model_type]
         new_model.model_options["transformer_options"]["use_ret_mode"] = "ret_mode" in model_type
+        new_model.model_options["transformer_options"]["uncond_reuse"] = uncond_reuse
+        new_model.model_options["transformer_options"]["skip_signal"] = skip_signal
         diffusion_model = new_model.get_model_object("diffusion_model")
 
+        model_sampling = new_model.get_model_object("model_sampling")
+        # the TeaCache forward is installed as an object patch, it is only in place while this
+        # model is loaded and costs nothing per call
         if "chroma" in model_type:
             is_cfg = True
-            context = patch.multiple(
-                diffusion_model,
-                forward_orig=teacache_chroma_forward.__get__(diffusion_model, diffusion_model.__class__)
-            )
+            forward_name, forward = "forward_orig", teacache_chroma_forward
         elif "flux" in model_type:
             is_cfg = False
-            context = patch.multiple(
-                diffusion_model,
-                forward_orig=teacache_flux_forward.__get__(diffusion_model, diffusion_model.__class__)
-            )
+            forward_name, forward = "forward_orig", teacache_flux_forward
         elif "hidream_i1" in model_type:
             is_cfg = True
-            context = patch.multiple(
-                diffusion_model,
-                forward=teacache_hidream_forward.__get__(diffusion_model, diffusion_model.__class__)
-            )
+            forward_name, forward = "forward", teacache_hidream_forward
         elif "ltxv" in model_type:
             is_cfg = True
-            context = patch.multiple(
-                diffusion_model,
-                forward=teacache_ltxvmodel_forward.__get__(diffusion_model, diffusion_model.__class__)
-            )
+            forward_name, forward = "forward", teacache_ltxvmodel_forward
         elif "hunyuan_video" in model_type:
             is_cfg = False
-            context = patch.multiple(
-                diffusion_model,
-                forward_orig=teacache_hunyuanvideo_forward.__get__(diffusion_model, diffusion_model.__class__)
-            )
+            forward_name, forward = "forward_orig", teacache_hunyuanvideo_forward
         elif "wan2.1" in model_type:
             is_cfg = True
-            context = patch.multiple(
-                diffusion_model,
-                forward_orig=teacache_wanmodel_forward.__get__(diffusion_model, diffusion_model.__class__)
-            )
+            forward_name, forward = "forward_orig", teacache_wanmodel_forward
         else:
             raise ValueError(f"Unknown type {model_type}")
+        new_model.add_object_patch(f"diffusion_model.{forward_name}", forward.__get__(diffusion_model, diffusion_model.__class__))
         
+        runs = TeaCacheRuns()
         def unet_wrapper_function(model_function, kwargs):
             input = kwargs["input"]
             timestep = kwargs["timestep"]
             c = kwargs["c"]
             cond_or_uncond = kwargs["cond_or_uncond"]
-            # referenced from https://github.com/kijai/ComfyUI-KJNodes/blob/d126b62cebee81ea14ec06ea7cd7526999cb0554/nodes/model_optimization_nodes.py#L868
             sigmas = c["transformer_options"]["sample_sigmas"]
-            matched_step_index = (sigmas == timestep[0]).nonzero()
-            if len(matched_step_index) > 0:
-                current_step_index = matched_step_index.item()
+
+            run = runs.get(c["transformer_options"])
+            c["transformer_options"]["teacache_run"] = run
+            if run.get('sampler_run') and run.get('sampler_steps', True):
+                # the intermediate evaluations of second order samplers land on or between the
+                # sigmas, only the sampler callback tells which step they belong to
+                current_step_index, substep = count_substep(run, cond_or_uncond)
             else:
-                current_step_index = 0
-                for i in range(len(sigmas) - 1):
-                    # walk from beginning of steps until crossing the timestep
-                    if (sigmas[i] - timestep[0]) * (sigmas[i + 1] - timestep[0]) <= 0:
-                        current_step_index = i
-                        break
-            
-            if current_step_index == 0:
+                current_step_index, substep = get_step_index(sigmas, timestep[0]), 0
+            c["transformer_options"]["teacache_substep"] = substep
+            if not run.get('sampler_run'):
+                # the run can be released once its last step ran, the same sigmas may also start it again
+                run['last_step'] = current_step_index >= len(sigmas) - 2
+            if current_step_index == 0 and not run.get('sampler_run'):
+                # no sampler wrapper (older ComfyUI), a run starts at the first sigma
                 if is_cfg:
                     # uncond first
-                    if (1 in cond_or_uncond) and hasattr(diffusion_model, 'teacache_state'):
-                        delattr(diffusion_model, 'teacache_state')
+                    if 1 in cond_or_uncond:
+                        run.pop('teacache_states', None)
                 else:
-                    if hasattr(diffusion_model, 'accumulated_rel_l1_distance'):
-                        delattr(diffusion_model, 'accumulated_rel_l1_distance')
+                    run.pop('teacache_states', None)
             
             current_percent = current_step_index / (len(sigmas) - 1)
             c["transformer_options"]["current_percent"] = current_percent
+            if model_type in ("chroma", "flux", "hunyuan_video"):
+                # model timesteps of the whole schedule, the modulation inputs are precomputed from them
+                c["transformer_options"]["sample_timesteps"] = model_sampling.timestep(sigmas)
             if start_percent <= current_percent <= end_percent:
                 c["transformer_options"]["enable_teacache"] = True
             else:
                 c["transformer_options"]["enable_teacache"] = False
                 
-            with context:
-                return model_function(input, timestep, **c)
+            return model_function(input, timestep, **c)
 
         new_model.set_model_unet_function_wrapper(unet_wrapper_function)
 
+        def outer_sample_wrapper(executor, noise, latent_image, sampler, sigmas, denoise_mask=None, callback=None, disable_pbar=False, seed=None, **kwargs):
+            # every sampling call is its own run, whatever sigma it starts at
+            guider = executor.class_obj
+            run_id = runs.start(sigmas, inherit=stage_cache == "inherit")
+            guider.model_options.setdefault("transformer_options", {})["teacache_run_id"] = run_id
+
+            def step_callback(step, x0, x, total_steps):
+                runs.advance(run_id, step)
+                if callback is not None:
+                    return callback(step, x0, x, total_steps)
+
+            try:
+                return executor(noise, latent_image, sampler, sigmas, denoise_mask, step_callback, disable_pbar, seed, **kwargs)
+            finally:
+                runs.finish(run_id, keep=stage_cache == "inherit")
+
+        if hasattr(new_model, "add_wrapper_with_key"):
+            import comfy.patcher_extension
+            new_model.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.OUTER_SAMPLE, "teacache", outer_sample_wrapper)
+
         return (new_model,)
     
-def patch_optimized_module():
-    try:
-        from torch._dynamo.eval_frame import OptimizedModule
-    except ImportError:
-        return
+def flux_double_block_forward(block, img, txt, vec, pe, attn_mask=None, modulation_dims_img=None, modulation_dims_txt=None, cached_attn=None):
+    img_mod1, img_mod2 = block.img_mod(vec)
+    txt_mod1, txt_mod2 = block.txt_mod(vec)
+
+    if cached_attn is None:
+        # prepare image for attention
+        img_modulated = block.img_norm1(img)
+        img_modulated = apply_mod(img_modulated, (1 + img_mod1.scale), img_mod1.shift, modulation_dims_img)
+        img_qkv = block.img_attn.qkv(img_modulated)
+        img_q, img_k, img_v = img_qkv.view(img_qkv.shape[0], img_qkv.shape[1], 3, block.num_heads, -1).permute(2, 0, 3, 1, 4)
+        img_q, img_k = block.img_attn.norm(img_q, img_k, img_v)
+
+        # prepare txt for attention
+        txt_modulated = block.txt_norm1(txt)
+        txt_modulated = apply_mod(txt_modulated, (1 + txt_mod1.scale), txt_mod1.shift, modulation_dims_txt)
+        txt_qkv = block.txt_attn.qkv(txt_modulated)
+        txt_q, txt_k, txt_v = txt_qkv.view(txt_qkv.shape[0], txt_qkv.shape[1], 3, block.num_heads, -1).permute(2, 0, 3, 1, 4)
+        txt_q, txt_k = block.txt_attn.norm(txt_q, txt_k, txt_v)
+
+        if getattr(block, "flipped_img_txt", False):
+            attn = attention(torch.cat((img_q, txt_q), dim=2),
+                             torch.cat((img_k, txt_k), dim=2),
+                             torch.cat((img_v, txt_v), dim=2),
+                             pe=pe, mask=attn_mask)
+            img_attn, txt_attn = attn[:, : img.shape[1]], attn[:, img.shape[1]:]
+        else:
+            attn = attention(torch.cat((txt_q, img_q), dim=2),
+                             torch.cat((txt_k, img_k), dim=2),
+                             torch.cat((txt_v, img_v), dim=2),
+                             pe=pe, mask=attn_mask)
+            txt_attn, img_attn = attn[:, : txt.shape[1]], attn[:, txt.shape[1]:]
+
+        img_attn = block.img_attn.proj(img_attn)
+        txt_attn = block.txt_attn.proj(txt_attn)
+    else:
+        img_attn, txt_attn = cached_attn
 
-    if getattr(OptimizedModule, "_patched", False):
-        return
+    img = img + apply_mod(img_attn, img_mod1.gate, None, modulation_dims_img)
+    img = img + apply_mod(block.img_mlp(apply_mod(block.img_norm2(img), (1 + img_mod2.scale), img_mod2.shift, modulation_dims_img)), img_mod2.gate, None, modulation_dims_img)
 
-    def __getattribute__(self, name):
-        if name == "_orig_mod":
-            return object.__getattribute__(self, "_modules")[name]
-        if name in (
-            "__class__",
-            "_modules",
-            "state_dict",
-            "load_state_dict",
-            "parameters",
-            "named_parameters",
-            "buffers",
-            "named_buffers",
-            "children",
-            "named_children",
-            "modules",
-            "named_modules",
-        ):
-            return getattr(object.__getattribute__(self, "_orig_mod"), name)
-        return object.__getattribute__(self, name)
-
-    def __delattr__(self, name):
-        return delattr(self._orig_mod, name)
+    txt = txt + apply_mod(txt_attn, txt_mod1.gate, None, modulation_dims_txt)
+    txt = txt + apply_mod(block.txt_mlp(apply_mod(block.txt_norm2(txt), (1 + txt_mod2.scale), txt_mod2.shift, modulation_dims_txt)), txt_mod2.gate, None, modulation_dims_txt)
 
-    @classmethod
-    def __instancecheck__(cls, instance):
-        return isinstance(instance, OptimizedModule) or issubclass(
-            object.__getattribute__(instance, "__class__"), cls
+    if txt.dtype == torch.float16:
+        txt = torch.nan_to_num(txt, nan=0.0, posinf=65504, neginf=-65504)
+
+    return img, txt, (img_attn, txt_attn)
+
+def flux_single_block_forward(block, x, vec, pe, attn_mask=None, modulation_dims=None, cached_attn=None):
+    mod, _ = block.modulation(vec)
+    qkv, mlp = torch.split(block.linear1(apply_mod(block.pre_norm(x), (1 + mod.scale), mod.shift, modulation_dims)), [3 * block.hidden_size, block.mlp_hidden_dim], dim=-1)
+
+    if cached_attn is None:
+        q, k, v = qkv.view(qkv.shape[0], qkv.shape[1], 3, block.num_heads, -1).permute(2, 0, 3, 1, 4)
+        q, k = block.norm(q, k, v)
+        attn = attention(q, k, v, pe=pe, mask=attn_mask)
+    else:
+        attn, = cached_attn
+
+    # the mlp stream is always recomputed, only the attention output is reused
+    output = block.linear2(torch.cat((attn, block.mlp_act(mlp)), 2))
+    x = x + apply_mod(output, mod.gate, None, modulation_dims)
+
+    if x.dtype == torch.float16:
+        x = torch.nan_to_num(x, nan=0.0, posinf=65504, neginf=-65504)
+
+    return x, (attn,)
+
+def wan_block_forward(block, x, e, freqs, context, context_img_len=None, cached_attn=None):
+    e = (mm.cast_to(block.modulation, dtype=x.dtype, device=x.device) + e).chunk(6, dim=1)
+
+    # self-attention
+    if cached_attn is None:
+        y = block.self_attn(block.norm1(x) * (1 + e[1]) + e[0], freqs)
+    else:
+        y, = cached_attn
+    x = x + y * e[2]
+
+    # cross-attention & ffn
+    x = x + block.cross_attn(block.norm3(x), context, context_img_len=context_img_len)
+    y_ffn = block.ffn(block.norm2(x) * (1 + e[4]) + e[3])
+    x = x + y_ffn * e[5]
+
+    return x, (y,)
+
+# block attributes used by the block forwards above, blocks that do not have them run unpatched
+ATTENTION_CACHE_BLOCK_ATTRS = {
+    "double_block": ("img_mod", "txt_mod", "img_norm1", "img_attn", "img_norm2", "img_mlp", "txt_norm1", "txt_attn", "txt_norm2", "txt_mlp", "num_heads"),
+    "single_block": ("modulation", "pre_norm", "linear1", "linear2", "norm", "mlp_act", "hidden_size", "mlp_hidden_dim", "num_heads"),
+    "wan2.1": ("modulation", "norm1", "norm2", "norm3", "self_attn", "cross_attn", "ffn"),
+}
+
+class AttentionCachePatch:
+    """
+    Block replacement patch that caches the attention output of a single transformer block.
+    On reused steps the attention output is linearly extrapolated from the last two computed
+    steps (FasterCache style), while the modulation and MLP are still computed.
+    """
+    def __init__(self, diffusion_model, model_type, block_name, index, state, start_percent, end_percent, cache_interval, extrapolation, offload_cache):
+        self.diffusion_model = diffusion_model
+        self.model_type = model_type
+        self.block_name = block_name
+        self.index = index
+        self.state = state
+        self.start_percent = start_percent
+        self.end_percent = end_percent
+        self.cache_interval = cache_interval
+        self.extrapolation = extrapolation
+        self.offload_cache = offload_cache
+
+    def get_block(self):
+        if self.model_type == "wan2.1":
+            return self.diffusion_model.blocks[self.index]
+        if self.block_name == "double_block":
+            return self.diffusion_model.double_blocks[self.index]
+        return self.diffusion_model.single_blocks[self.index]
+
+    def is_supported(self, block):
+        supported = self.state.get("supported")
+        if supported is None:
+            supported = self.state["supported"] = {}
+        kind = "wan2.1" if self.model_type == "wan2.1" else self.block_name
+        if kind not in supported:
+            missing = [name for name in ATTENTION_CACHE_BLOCK_ATTRS[kind] if not hasattr(block, name)]
+            if missing:
+                print(f"[TeaCache] Attention Cache: {type(block).__name__} has no {', '.join(missing)}, running the blocks unpatched.")
+            supported[kind] = not missing
+        return supported[kind]
+
+    def update_step(self, transformer_options):
+        sample_sigmas = transformer_options.get("sample_sigmas")
+        sigmas = transformer_options.get("sigmas")
+        if sample_sigmas is None or sigmas is None:
+            return False
+
+        state = self.state
+        if state.get("sample_sigmas") is not sample_sigmas:
+            # new sampling run
+            state["sample_sigmas"] = sample_sigmas
+            state["sigmas"] = None
+            state["entries"] = {}
+
+        if state["sigmas"] is not sigmas:
+            state["sigmas"] = sigmas
+            total_steps = max(len(sample_sigmas) - 1, 1)
+            step = get_step_index(sample_sigmas, sigmas[0])
+            start_step = math.ceil(self.start_percent * total_steps)
+            end_step = math.floor(self.end_percent * total_steps)
+            state["step"] = step
+            state["in_window"] = start_step <= step <= end_step
+            state["reuse"] = state["in_window"] and (step - start_step) % self.cache_interval != 0
+        return True
+
+    def get_cached_attn(self, key, x):
+        entry = self.state["entries"].get(key)
+        if not self.state["reuse"] or entry is None:
+            return None
+        older, newer = entry["attn"]
+        if newer[0].shape != x.shape:
+            return None
+        return tuple(
+            (n + (n - o) * self.extrapolation).to(device=x.device, dtype=x.dtype, non_blocking=True)
+            for o, n in zip(older, newer)
         )
 
-    OptimizedModule.__getattribute__ = __getattribute__
-    OptimizedModule.__delattr__ = __delattr__
-    OptimizedModule.__instancecheck__ = __instancecheck__
-    OptimizedModule._patched = True
+    def store_attn(self, key, attn):
+        if not self.state["in_window"]:
+            return
+        cache_device = mm.unet_offload_device() if self.offload_cache else attn[0].device
+        attn = tuple(a.to(cache_device) for a in attn)
+        step = self.state["step"]
+        entry = self.state["entries"].get(key)
+        if entry is None or entry["attn"][1][0].shape != attn[0].shape:
+            self.state["entries"][key] = {"step": step, "attn": [attn, attn]}
+        elif entry["step"] == step:
+            entry["attn"][1] = attn
+        else:
+            entry["attn"] = [entry["attn"][1], attn]
+            entry["step"] = step
+
+    def __call__(self, args, extra_options):
+        # native forwards of older ComfyUI do not pass transformer_options to the block patches,
+        # the diffusion model wrapper of the node keeps them for that case
+        transformer_options = extra_options.get("transformer_options") or self.state.get("transformer_options", {})
+        block = self.get_block()
+        if not self.update_step(transformer_options) or not self.is_supported(block):
+            return extra_options["original_block"](args)
+
+        cond_or_uncond = tuple(transformer_options.get("cond_or_uncond", []))
+        key = (self.block_name, self.index, cond_or_uncond)
+        cached_attn = self.get_cached_attn(key, args["img"])
+
+        if self.model_type == "wan2.1":
+            # the native forward does not pass it, i2v blocks take the 257 clip tokens in front of the context
+            context_img_len = args.get("context_img_len", 257 if hasattr(block.cross_attn, "k_img") else None)
+            img, attn = wan_block_forward(block, args["img"], args["vec"], args["pe"], args["txt"], context_img_len=context_img_len, cached_attn=cached_attn)
+            out = {"img": img}
+        elif self.block_name == "double_block":
+            img, txt, attn = flux_double_block_forward(
+                block, args["img"], args["txt"], args["vec"], args["pe"],
+                attn_mask=args.get("attn_mask", args.get("attention_mask")),
+                modulation_dims_img=args.get("modulation_dims_img"),
+                modulation_dims_txt=args.get("modulation_dims_txt"),
+                cached_attn=cached_attn,
+            )
+            out = {"img": img, "txt": txt}
+        else:
+            img, attn = flux_single_block_forward(
+                block, args["img"], args["vec"], args["pe"],
+                attn_mask=args.get("attn_mask", args.get("attention_mask")),
+                modulation_dims=args.get("modulation_dims"),
+                cached_attn=cached_attn,
+            )
+            out = {"img": img}
+
+        if cached_attn is None:
+            self.store_attn(key, attn)
+        return out
+
+class AttentionCache:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "model": ("MODEL", {"tooltip": "The diffusion model the attention cache will be applied to."}),
+                "model_type": (["flux", "hunyuan_video", "wan2.1"], {"default": "flux", "tooltip": "Supported diffusion model."}),
+                "start_percent": ("FLOAT", {"default": 0.3, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The start percentage of the steps that will reuse cached attention outputs."}),
+                "end_percent": ("FLOAT", {"default": 0.9, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The end percentage of the steps that will reuse cached attention outputs."}),
+                "cache_interval": ("INT", {"default": 3, "min": 1, "max": 100, "step": 1, "tooltip": "Attention is fully computed every cache_interval steps inside the window, the steps in between reuse the cache. 1 disables reuse."}),
+                "extrapolation": ("FLOAT", {"default": 0.3, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "How strongly to extrapolate the cached attention outputs from the last two computed steps."}),
+                "offload_cache": ("BOOLEAN", {"default": False, "tooltip": "Keep the cached attention outputs on the offload device to save VRAM."}),
+            }
+        }
+
+    RETURN_TYPES = ("MODEL",)
+    RETURN_NAMES = ("model",)
+    FUNCTION = "apply_attention_cache"
+    CATEGORY = "TeaCache"
+    TITLE = "Attention Cache"
+
+    def apply_attention_cache(self, model, model_type: str, start_percent: float, end_percent: float, cache_interval: int, extrapolation: float, offload_cache: bool):
+        if cache_interval <= 1:
+            return (model,)
+
+        new_model = model.clone()
+        diffusion_model = new_model.get_model_object("diffusion_model")
+
+        if model_type == "wan2.1":
+            blocks = [("double_block", len(diffusion_model.blocks))]
+        elif model_type in ("flux", "hunyuan_video"):
+            blocks = [("double_block", len(diffusion_model.double_blocks)), ("single_block", len(diffusion_model.single_blocks))]
+        else:
+            raise ValueError(f"Unknown type {model_type}")
+
+        state = {}
+        for block_name, num_blocks in blocks:
+            for i in range(num_blocks):
+                patch = AttentionCachePatch(diffusion_model, model_type, block_name, i, state, start_percent, end_percent, cache_interval, extrapolation, offload_cache)
+                new_model.set_model_patch_replace(patch, "dit", block_name, i)
+
+        def diffusion_model_wrapper(executor, *args, **kwargs):
+            state["transformer_options"] = kwargs.get("transformer_options", {})
+            return executor(*args, **kwargs)
+
+        if hasattr(new_model, "add_wrapper_with_key"):
+            import comfy.patcher_extension
+            new_model.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.DIFFUSION_MODEL, "attention_cache", diffusion_model_wrapper)
+        else:
+            print("[TeaCache] Attention Cache needs a ComfyUI with model wrappers or the TeaCache node, otherwise it stays inactive.")
+
+        return (new_model,)
+
+class RefCountedPatch:
+    """
+    Sets `name` of `target` to `value` while at least one caller is inside `with patch:` and restores
+    the original when the last one leaves, so overlapping compiled calls can't restore it under
+    each other.
+    """
+    def __init__(self, target, name, value):
+        self.target = target
+        self.name = name
+        self.value = value
+        self.lock = threading.Lock()
+        self.users = 0
+        self.previous = None
+
+    def __enter__(self):
+        with self.lock:
+            if self.users == 0:
+                self.previous = getattr(self.target, self.name)
+                setattr(self.target, self.name, self.value)
+            self.users += 1
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.users -= 1
+            if self.users == 0:
+                setattr(self.target, self.name, self.previous)
+
+compile_patches = {}
+compile_patches_lock = threading.Lock()
+
+def get_compile_patch(name):
+    """
+    Shared RefCountedPatch of the globals swapped while a model compiled by Compile Model runs (and
+    compiles), None if this torch version does not have them.
+
+    "same_meta": inductor's `post_grad.same_meta` raises on some tensors of the patched forwards
+    instead of returning False, it is replaced by a tolerant version.
+    "suppress_errors": falls back to eager when the whole diffusion model fails to compile.
+    "inline_inbuilt_nn_modules": lifts the module parameters to graph inputs, so the blocks of the
+    regional compile scope share one graph.
+    """
+    with compile_patches_lock:
+        if name not in compile_patches:
+            compile_patches[name] = None
+            if name == "same_meta":
+                try:
+                    from torch._inductor.fx_passes import post_grad
+                except ImportError:
+                    post_grad = None
+                same_meta = getattr(post_grad, "same_meta", None)
+                if same_meta is not None:
+                    def tolerant_same_meta(a, b):
+                        try:
+                            return same_meta(a, b)
+                        except Exception:
+                            return False
+                    compile_patches[name] = RefCountedPatch(post_grad, "same_meta", tolerant_same_meta)
+            elif name == "suppress_errors":
+                compile_patches[name] = RefCountedPatch(torch._dynamo.config, "suppress_errors", True)
+            elif name == "inline_inbuilt_nn_modules":
+                if hasattr(torch._dynamo.config, "inline_inbuilt_nn_modules"):
+                    compile_patches[name] = RefCountedPatch(torch._dynamo.config, "inline_inbuilt_nn_modules", True)
+        return compile_patches[name]
+
+def with_compile_patches(fn, suppress_errors=False, inline_modules=False):
+    names = ["same_meta"]
+    if suppress_errors:
+        names.append("suppress_errors")
+    if inline_modules:
+        names.append("inline_inbuilt_nn_modules")
+    patches = [patch for patch in map(get_compile_patch, names) if patch is not None]
+    if not patches:
+        return fn
+
+    def call(*args, **kwargs):
+        with contextlib.ExitStack() as stack:
+            for patch in patches:
+                stack.enter_context(patch)
+            return fn(*args, **kwargs)
+
+    return call
+
+def compiled_module_proxy(module, compiled, suppress_errors=False, buckets=None):
+    """
+    Stand-in for `module` that runs `compiled` when called. The proxy is an instance of a
+    per-module subclass of the original class and shares its `__dict__`, so the TeaCache state,
+    parameters and submodules are read and written on the original module at plain attribute
+    access speed, and isinstance checks and state_dict keys are unchanged. With `buckets` the
+    input tensor is marked dynamic by the bucketed shape policy right before the compiled call.
+    """
+    compiled_call = with_compile_patches(compiled, suppress_errors)
+
+    def call(self, *args, **kwargs):
+        if buckets is not None and args:
+            # the model casts and concats the sampler input before calling us, so only this tensor reaches the graph
+            buckets.mark_input(args[0])
+        return compiled_call(*args, **kwargs)
+
+    proxy_class = type(f"Compiled{type(module).__name__}", (type(module),), {"__call__": call})
+    proxy = object.__new__(proxy_class)
+    proxy.__dict__ = module.__dict__
+    return proxy
+
+# block lists of the supported diffusion models, compiled one block at a time by the "blocks" compile scope
+COMPILE_BLOCK_LISTS = ("double_blocks", "single_blocks", "double_stream_blocks", "single_stream_blocks", "transformer_blocks", "blocks")
+
+def compile_blocks(model, compile_fn):
+    """
+    Object patch every transformer block with its compiled version. The forward around the
+    blocks, including the TeaCache skip decision, stays in eager Python, so its tensor-value
+    branches and state mutation never cause graph breaks or recompiles.
+    """
+    diffusion_model = model.get_model_object("diffusion_model")
+    num_compiled = 0
+    for list_name in COMPILE_BLOCK_LISTS:
+        blocks = getattr(diffusion_model, list_name, None)
+        if not isinstance(blocks, torch.nn.ModuleList):
+            continue
+        for i, block in enumerate(blocks):
+            model.add_object_patch(f"diffusion_model.{list_name}.{i}", compiled_module_proxy(block, compile_fn(block)))
+            num_compiled += 1
+    return num_compiled
+
+def compile_blocks_regional(model, compile_fn):
+    """
+    Compile the forward of each transformer block class once and bind the shared compiled
+    function to every block of that class. With the parameters lifted to graph inputs, all
+    identical blocks reuse one graph, so the warm-up compiles one block instead of the whole
+    stack.
+    """
+    diffusion_model = model.get_model_object("diffusion_model")
+    compiled_forwards = {}
+    num_compiled = 0
+    for list_name in COMPILE_BLOCK_LISTS:
+        blocks = getattr(diffusion_model, list_name, None)
+        if not isinstance(blocks, torch.nn.ModuleList):
+            continue
+        for i, block in enumerate(blocks):
+            block_class = type(block)
+            if block_class not in compiled_forwards:
+                compiled_forwards[block_class] = with_compile_patches(compile_fn(block_class.forward), inline_modules=True)
+            model.add_object_patch(f"diffusion_model.{list_name}.{i}.forward", types.MethodType(compiled_forwards[block_class], block))
+            num_compiled += 1
+    return num_compiled
+
+COMPILE_CACHE_DIR = os.path.join(folder_paths.get_user_directory(), "teacache", "compile_cache")
+loaded_compile_caches = set()
+
+def get_compile_stats():
+    try:
+        from torch._dynamo.utils import counters
+    except ImportError:
+        return {"graph_breaks": 0, "frames": 0, "cache_hits": 0, "cache_misses": 0}
+    return {
+        "graph_breaks": sum(counters["graph_break"].values()),
+        "frames": counters["frames"]["ok"],
+        "cache_hits": counters["inductor"]["fxgraph_cache_hit"],
+        "cache_misses": counters["inductor"]["fxgraph_cache_miss"],
+    }
+
+def get_compile_cache_key(diffusion_model, *options):
+    """
+    Compiled graphs depend on the architecture and dtypes of the model, not on its weights, so the
+    key hashes parameter names, shapes and dtypes together with the compile options. The input
+    shapes are keyed inside the cache itself, one file holds the artifacts of every shape compiled.
+    """
+    key = hashlib.sha1()
+    key.update(type(diffusion_model).__qualname__.encode())
+    for name, tensor in itertools.chain(diffusion_model.named_parameters(), diffusion_model.named_buffers()):
+        key.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+    key.update(repr((torch.__version__,) + options).encode())
+    return key.hexdigest()[:16]
+
+def set_compile_cache_env(cache_dir):
+    """
+    inductor and triton read their on-disk cache dirs from the environment, there is no config option
+    for them. They are pointed next to the artifacts once, by the first cached model, unless the user
+    set them. The environment is process-wide, so it is not swapped per model or per call.
+    """
+    for name, subdir in (("TORCHINDUCTOR_CACHE_DIR", "inductor"), ("TRITON_CACHE_DIR", "triton")):
+        if not os.environ.get(name):
+            os.environ[name] = os.path.join(cache_dir, subdir)
+    inductor_dir = os.environ["TORCHINDUCTOR_CACHE_DIR"]
+    if inductor_dir != os.path.join(cache_dir, "inductor"):
+        print(f"[TeaCache] Inductor cache dir: {inductor_dir} (already set by TORCHINDUCTOR_CACHE_DIR or an earlier cache_dir)")
+    else:
+        print(f"[TeaCache] Inductor cache dir: {inductor_dir}")
 
-def patch_same_meta():
+def setup_compile_cache(cache_dir, cache_key):
+    os.makedirs(cache_dir, exist_ok=True)
+    set_compile_cache_env(cache_dir)
     try:
-        from torch._inductor.fx_passes import post_grad
+        import torch._inductor.config
+        torch._inductor.config.fx_graph_cache = True
     except ImportError:
-        return
+        pass
+
+    cache_path = os.path.join(cache_dir, f"{cache_key}.bin")
+    load_fn = getattr(torch.compiler, "load_cache_artifacts", None)
+    if load_fn is None or cache_path in loaded_compile_caches:
+        return cache_path
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            load_fn(f.read())
+        loaded_compile_caches.add(cache_path)
+        print(f"[TeaCache] Compile cache hit: loaded {cache_path}")
+    else:
+        print(f"[TeaCache] Compile cache miss: {cache_path} will be written after the first run")
+    return cache_path
 
-    same_meta = getattr(post_grad, "same_meta", None)
-    if same_meta is None:
+def save_compile_cache(cache_path):
+    save_fn = getattr(torch.compiler, "save_cache_artifacts", None)
+    if save_fn is None:
         return
-
-    if getattr(same_meta, "_patched", False):
+    artifacts = save_fn()
+    if artifacts is None:
         return
-
-    def new_same_meta(a, b):
-        try:
-            return same_meta(a, b)
-        except Exception:
-            return False
-
-    post_grad.same_meta = new_same_meta
-    new_same_meta._patched = True
+    artifact_bytes, _ = artifacts
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(artifact_bytes)
+    os.replace(tmp_path, cache_path)
+    loaded_compile_caches.add(cache_path)
+    print(f"[TeaCache] Compile cache saved to {cache_path} ({len(artifact_bytes) / 1024 ** 2:.1f} MB)")
+
+def compile_run_wrapper(prev_wrapper, report=False, cache_path=None, buckets=None):
+    """
+    unet wrapper tracking the compilations of every sampling run. Frames compiled after the first
+    step are counted as recompilations. Prints a report if `report` is set and writes the compile
+    cache to `cache_path` when the run compiled anything new. With `buckets` the calls are timed
+    per shape bucket for the report.
+    """
+    def call(model_function, kwargs):
+        if prev_wrapper is not None:
+            return prev_wrapper(model_function, kwargs)
+        return model_function(kwargs["input"], kwargs["timestep"], **kwargs["c"])
+
+    run = {}
+
+    def unet_wrapper_function(model_function, kwargs):
+        sigmas = kwargs["c"]["transformer_options"].get("sample_sigmas")
+        current_step_index = get_step_index(sigmas, kwargs["timestep"][0]) if sigmas is not None else None
+
+        if current_step_index == 0 and run.get("step_index") != 0:
+            run.update(start=get_compile_stats(), warm=None, finished=False)
+        elif current_step_index is not None and current_step_index > 0 and run.get("warm") is None and "start" in run:
+            run["warm"] = get_compile_stats()
+        run["step_index"] = current_step_index
+
+        if buckets is not None:
+            output = call_bucketed(buckets, model_function, kwargs, call)
+        else:
+            output = call(model_function, kwargs)
+
+        if current_step_index is not None and current_step_index >= len(sigmas) - 2 and not run.get("finished", True):
+            run["finished"] = True
+            end = get_compile_stats()
+            warm = run["warm"] or end
+            compiled = warm["frames"] - run["start"]["frames"]
+            recompiled = end["frames"] - warm["frames"]
+            if report:
+                graph_breaks = end["graph_breaks"] - run["start"]["graph_breaks"]
+                cache_hits = end["cache_hits"] - run["start"]["cache_hits"]
+                cache_misses = end["cache_misses"] - run["start"]["cache_misses"]
+                print(f"[TeaCache] torch.compile: {graph_breaks} graph breaks, {compiled} frames compiled on the first step, {recompiled} recompilations, {cache_hits} graph cache hits, {cache_misses} misses")
+                if buckets is not None:
+                    buckets.report()
+            if cache_path is not None and compiled + recompiled > 0:
+                save_compile_cache(cache_path)
+        return output
+
+    return unet_wrapper_function
+
+def parse_resolutions(resolutions):
+    shapes = []
+    for item in resolutions.replace(";", ",").split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        values = [int(v) for v in item.split("x")]
+        if len(values) not in (2, 3):
+            raise ValueError(f"Invalid resolution '{item}', expected WIDTHxHEIGHT or WIDTHxHEIGHTxFRAMES")
+        shapes.append((values[0], values[1], values[2] if len(values) == 3 else 1))
+    return shapes
+
+def get_latent_shape(latent_format, width, height, frames, batch_size=1):
+    spacial_ratio = getattr(latent_format, "spacial_downscale_ratio", 8)
+    temporal_ratio = getattr(latent_format, "temporal_downscale_ratio", 4)
+    shape = [batch_size, latent_format.latent_channels]
+    if getattr(latent_format, "latent_dimensions", 2) == 3:
+        shape.append((frames - 1) // temporal_ratio + 1)
+    return shape + [height // spacial_ratio, width // spacial_ratio]
+
+class ShapeBuckets:
+    """
+    Bucketed dynamic-shape policy. The latent dims of the model input (frames, height, width) are
+    marked dynamic up to the smallest bucket that fits them and the batch dim up to `max_batch`,
+    channel dims stay static. Inputs inside a compiled bucket reuse its graph instead of recompiling.
+    Dims of size 1 are always specialized by torch.compile, so a batch of 1 has its own graph.
+    """
+    def __init__(self, latent_format, resolutions, max_batch=16, report=False):
+        shapes = [tuple(get_latent_shape(latent_format, w, h, f)[2:]) for w, h, f in parse_resolutions(resolutions)]
+        self.shapes = sorted(set(shapes), key=math.prod)
+        self.max_batch = max_batch
+        self.report_enabled = report
+        self.stats = {}
+
+    def find(self, dims):
+        for shape in self.shapes:
+            if len(shape) == len(dims) and all(d <= s for d, s in zip(dims, shape)):
+                return shape
+        return None
+
+    def mark_input(self, x):
+        bucket = self.find(tuple(x.shape[2:]))
+        if bucket is not None:
+            self.mark_dynamic(x, bucket)
+
+    def mark_dynamic(self, x, bucket):
+        for dim, max_size in enumerate(bucket, start=x.ndim - len(bucket)):
+            if x.shape[dim] >= 2 and max_size > 2:
+                torch._dynamo.mark_dynamic(x, dim, min=2, max=max_size)
+        if x.shape[0] >= 2:
+            torch._dynamo.mark_dynamic(x, 0, min=2, max=self.max_batch)
+
+    def record(self, bucket, elapsed, compiled):
+        stats = self.stats.setdefault(bucket, {"calls": 0, "time": 0.0, "compiled": 0})
+        stats["calls"] += 1
+        stats["time"] += elapsed
+        stats["compiled"] += compiled
+
+    def report(self):
+        for bucket, stats in self.stats.items():
+            name = "x".join(str(d) for d in bucket) if bucket is not None else "unbucketed"
+            avg_ms = stats["time"] / stats["calls"] * 1000
+            print(f"[TeaCache]   bucket {name}: {stats['calls']} calls, {avg_ms:.1f} ms per call, {stats['compiled']} compilations")
+        self.stats = {}
+
+def call_bucketed(buckets, model_function, kwargs, call):
+    # the input is marked dynamic by the compiled model proxy, the sampler input is only used to time its bucket
+    if not buckets.report_enabled:
+        return call(model_function, kwargs)
+    x = kwargs["input"]
+    bucket = buckets.find(tuple(x.shape[2:]))
+
+    # the per-bucket times are only measured for the report, synchronizing stalls the launch queue
+    frames = get_compile_stats()["frames"]
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    start = time.perf_counter()
+    output = call(model_function, kwargs)
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    buckets.record(bucket, time.perf_counter() - start, get_compile_stats()["frames"] - frames)
+    return output
+
+def warm_up_model(model, positive, negative, resolutions, steps=2, cfg=1.0, sampler_name="euler", scheduler="simple", batch_size=1):
+    """
+    Run a short sampling at every expected resolution so torch.compile builds (or loads from the
+    compile cache) the graphs before the first real job. Can also be called from a worker start-up script.
+    """
+    import comfy.sample
+
+    latent_format = model.get_model_object("latent_format")
+    for width, height, frames in parse_resolutions(resolutions):
+        shape = get_latent_shape(latent_format, width, height, frames, batch_size)
+        latent = comfy.sample.fix_empty_latent_channels(model, torch.zeros(shape))
+        noise = comfy.sample.prepare_noise(latent, 0)
+
+        start = time.perf_counter()
+        comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent, disable_pbar=True, seed=0)
+        print(f"[TeaCache] Warm-up {width}x{height}x{frames}: {time.perf_counter() - start:.2f} s")
 
 class CompileModel:
     @classmethod
@@ -1133,6 +2176,13 @@ class CompileModel:
                 "backend": (["inductor","cudagraphs", "eager", "aot_eager"], {"default": "inductor"}),
                 "fullgraph": ("BOOLEAN", {"default": False, "tooltip": "Enable full graph mode"}),
                 "dynamic": ("BOOLEAN", {"default": False, "tooltip": "Enable dynamic mode"}),
+            },
+            "optional": {
+                "compile_scope": (["model", "blocks", "regional"], {"default": "model", "tooltip": "model compiles the whole diffusion model, blocks compiles only the transformer blocks and keeps the TeaCache skip logic in eager mode, regional compiles one forward per block type and shares it between all identical blocks."}),
+                "report": ("BOOLEAN", {"default": False, "tooltip": "Print the number of graph breaks and recompilations of every sampling run."}),
+                "cache": ("BOOLEAN", {"default": False, "tooltip": "Persist the compiled artifacts on disk and load them on the next start."}),
+                "cache_dir": ("STRING", {"default": "", "tooltip": "Directory of the compile cache, empty uses user/teacache/compile_cache."}),
+                "shape_buckets": ("STRING", {"default": "", "tooltip": "Comma separated WIDTHxHEIGHT or WIDTHxHEIGHTxFRAMES buckets. The latent and batch dims are compiled dynamic up to the bucket that fits the input, empty keeps the dynamic setting. Only with the model compile scope."}),
             }
         }
     
@@ -1142,29 +2192,77 @@ class CompileModel:
     CATEGORY = "TeaCache"
     TITLE = "Compile Model"
     
-    def apply_compile(self, model, mode: str, backend: str, fullgraph: bool, dynamic: bool):
-        patch_optimized_module()
-        patch_same_meta()
-        torch._dynamo.config.suppress_errors = True
-        
+    def apply_compile(self, model, mode: str, backend: str, fullgraph: bool, dynamic: bool, compile_scope: str = "model", report: bool = False, cache: bool = False, cache_dir: str = "", shape_buckets: str = ""):
+        cache_path = None
+        if cache:
+            cache_key = get_compile_cache_key(model.get_model_object("diffusion_model"), mode, backend, fullgraph, dynamic, compile_scope)
+            cache_path = setup_compile_cache(cache_dir or COMPILE_CACHE_DIR, cache_key)
+
+        buckets = None
+        if shape_buckets.strip():
+            # the buckets mark the input of the whole model, the compiled blocks never see it
+            if compile_scope != "model":
+                raise ValueError(f"shape_buckets only work with the model compile scope, not {compile_scope}")
+            buckets = ShapeBuckets(model.get_model_object("latent_format"), shape_buckets, report=report)
+            if dynamic:
+                print("[TeaCache] dynamic is enabled, every dim is compiled dynamic and shape_buckets only bound the marked dims.")
+            else:
+                # dynamic=False would ignore the marked dims, None lets torch.compile honor them
+                dynamic = None
+
+        def compile_fn(target):
+            return torch.compile(target, mode=mode, backend=backend, fullgraph=fullgraph, dynamic=dynamic)
+
         new_model = model.clone()
-        new_model.add_object_patch(
-                                "diffusion_model",
-                                torch.compile(
-                                    new_model.get_model_object("diffusion_model"),
-                                    mode=mode,
-                                    backend=backend,
-                                    fullgraph=fullgraph,
-                                    dynamic=dynamic
-                                )
-                            )
-        
+        num_compiled = 0
+        if compile_scope == "blocks":
+            num_compiled = compile_blocks(new_model, compile_fn)
+        elif compile_scope == "regional":
+            num_compiled = compile_blocks_regional(new_model, compile_fn)
+        if num_compiled == 0:
+            if compile_scope != "model":
+                print("[TeaCache] No transformer blocks found, compiling the whole diffusion model.")
+            diffusion_model = new_model.get_model_object("diffusion_model")
+            new_model.add_object_patch("diffusion_model", compiled_module_proxy(diffusion_model, compile_fn(diffusion_model), suppress_errors=True, buckets=buckets))
+
+        if report or cache_path is not None or buckets is not None:
+            new_model.set_model_unet_function_wrapper(compile_run_wrapper(new_model.model_options.get("model_function_wrapper"), report, cache_path, buckets))
+
         return (new_model,)
     
 
+class CompileWarmup:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "model": ("MODEL", {"tooltip": "The compiled diffusion model to warm up."}),
+                "positive": ("CONDITIONING", ),
+                "negative": ("CONDITIONING", ),
+                "resolutions": ("STRING", {"default": "1024x1024", "tooltip": "Comma separated WIDTHxHEIGHT or WIDTHxHEIGHTxFRAMES to precompile."}),
+                "steps": ("INT", {"default": 2, "min": 1, "max": 100, "step": 1, "tooltip": "Sampling steps of every warm-up run."}),
+                "cfg": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 100.0, "step": 0.1, "tooltip": "Use the cfg of the real jobs, cfg 1.0 and higher compile different batch sizes."}),
+                "sampler_name": (comfy.samplers.KSampler.SAMPLERS, {"default": "euler", "tooltip": "Use the sampler of the real jobs, samplers passing different inputs to the model compile different graphs."}),
+                "scheduler": (comfy.samplers.KSampler.SCHEDULERS, {"default": "simple", "tooltip": "Use the scheduler of the real jobs."}),
+            }
+        }
+
+    RETURN_TYPES = ("MODEL",)
+    RETURN_NAMES = ("model",)
+    FUNCTION = "warm_up"
+    CATEGORY = "TeaCache"
+    TITLE = "Compile Warm-up"
+
+    def warm_up(self, model, positive, negative, resolutions: str, steps: int, cfg: float, sampler_name: str = "euler", scheduler: str = "simple"):
+        warm_up_model(model, positive, negative, resolutions, steps, cfg, sampler_name, scheduler)
+        return (model,)
+
+
 NODE_CLASS_MAPPINGS = {
     "TeaCache": TeaCache,
-    "CompileModel": CompileModel
+    "AttentionCache": AttentionCache,
+    "CompileModel": CompileModel,
+    "CompileWarmup": CompileWarmup
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {k: v.TITLE for k, v in NODE_CLASS_MAPPINGS.items()}
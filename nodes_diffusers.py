@@ -1,12 +1,14 @@
 import torch
 import numpy as np
 
-from einops import rearrange
 from typing import Optional, Tuple, Union
 from diffusers.models.modeling_outputs import Transformer2DModelOutput
 
-from .models.cogvideox.custom_cogvideox_transformer_3d import CogVideoXTransformer3DModel
-from .models.cogvideox.enhance_a_video.globals import set_num_frames
+from .models.cogvideox.custom_cogvideox_transformer_3d import CogVideoXTransformer3DModel, fuse_qkv_projections, set_attention_mode, install_attention_processors, set_teacache_pipe, get_teacache_scheduler
+from .models.cogvideox.embeddings import cache_positional_embeddings
+from .models.cogvideox.enhance_a_video.globals import bind_enhance_context, begin_enhance_step, end_enhance_step, get_scheduler_step
+from .models.cogvideox.enhance_a_video.globals import set_enhance_refresh, set_enhance_workspace, set_enhance_num_samples, set_enhance_report
+from .fastercache import FrequencyDelta
 
 def poly1d(coefficients, x):
     result = torch.zeros_like(x)
@@ -14,22 +16,11 @@ def poly1d(coefficients, x):
         result += coeff * (x ** (len(coefficients) - 1 - i))
     return result.abs()
 
-def fft(tensor):
-    tensor_fft = torch.fft.fft2(tensor)
-    tensor_fft_shifted = torch.fft.fftshift(tensor_fft)
-    B, C, H, W = tensor.size()
-    radius = min(H, W) // 5
-            
-    Y, X = torch.meshgrid(torch.arange(H), torch.arange(W), indexing='ij')
-    center_x, center_y = W // 2, H // 2
-    mask = (X - center_x) ** 2 + (Y - center_y) ** 2 <= radius ** 2
-    low_freq_mask = mask.unsqueeze(0).unsqueeze(0).to(tensor.device)
-    high_freq_mask = ~low_freq_mask
-            
-    low_freq_fft = tensor_fft_shifted * low_freq_mask
-    high_freq_fft = tensor_fft_shifted * high_freq_mask
-
-    return low_freq_fft, high_freq_fft
+def get_step_percent(scheduler, timestep):
+    step_index, num_steps = get_scheduler_step(scheduler, timestep)
+    if step_index is None:
+        return None, 0.0
+    return step_index, step_index / num_steps
 
 def teacache_cogvideox_forward(
         self,
@@ -46,7 +37,7 @@ def teacache_cogvideox_forward(
     ):
         batch_size, num_frames, channels, height, width = hidden_states.shape
 
-        set_num_frames(num_frames) # enhance a video global
+        bind_enhance_context(self, num_frames) # enhance a video context of this thread
    
         # 1. Time embedding
         timesteps = timestep
@@ -75,187 +66,160 @@ def teacache_cogvideox_forward(
         hidden_states = hidden_states[:, text_seq_length:]
 
         # enable teacache
-        if not hasattr(self, 'accumulated_rel_l1_distance'):
-            should_calc = True
-            self.accumulated_rel_l1_distance = 0
+        if not self.config.use_rotary_positional_embeddings:
+            # CogVideoX-2B
+            coefficients = [-3.10658903e+01, 2.54732368e+01, -5.92380459e+00, 1.75769064e+00, -3.61568434e-03]
         else:
-            try:
-                if not self.config.use_rotary_positional_embeddings:
-                    # CogVideoX-2B
-                    coefficients = [-3.10658903e+01, 2.54732368e+01, -5.92380459e+00, 1.75769064e+00, -3.61568434e-03]
-                else:
-                    # CogVideoX-5B
-                    coefficients = [-1.53880483e+03, 8.43202495e+02, -1.34363087e+02, 7.97131516e+00, -5.23162339e-02]
-                
-                self.accumulated_rel_l1_distance += poly1d(coefficients, ((emb-self.previous_modulated_input).abs().mean() / self.previous_modulated_input.abs().mean()))
-                if self.accumulated_rel_l1_distance < self.rel_l1_thresh:
-                    should_calc = False
-                else:
-                    should_calc = True
-                    self.accumulated_rel_l1_distance = 0
-            except:
-                should_calc = True
-                self.accumulated_rel_l1_distance = 0
+            # CogVideoX-5B
+            coefficients = [-1.53880483e+03, 8.43202495e+02, -1.34363087e+02, 7.97131516e+00, -5.23162339e-02]
 
-        self.previous_modulated_input = emb
+        current_timestep = timestep.flatten()[0].item() if torch.is_tensor(timestep) else float(timestep)
+        scheduler = get_teacache_scheduler(self)
+        step_index, current_percent = get_step_percent(scheduler, current_timestep)
+        last_timestep = getattr(self, 'teacache_last_timestep', None)
+        if not hasattr(self, 'teacache_state') or step_index == 0 or (step_index is None and (last_timestep is None or current_timestep >= last_timestep)):
+            # new run
+            self.teacache_state = {}
+        self.teacache_last_timestep = current_timestep
 
         if self.use_fastercache:
             self.fastercache_counter += 1
-            # Initialize delta_lf and delta_hf if they don't exist, crucial for the FFT path
-            if not hasattr(self, 'delta_lf'):
-                self.delta_lf = torch.tensor(0.0, device=hidden_states.device, dtype=torch.float32) # FFT ops use float32
-            if not hasattr(self, 'delta_hf'):
-                self.delta_hf = torch.tensor(0.0, device=hidden_states.device, dtype=torch.float32)
 
-        if self.fastercache_counter >= self.fastercache_start_step + 3 and self.fastercache_counter % 5 != 0:
-            if not should_calc:
-                hidden_states += self.previous_residual
-                encoder_hidden_states += self.previous_residual_encoder
-            else:
-                ori_hidden_states = hidden_states.clone()
-                ori_encoder_hidden_states = encoder_hidden_states.clone()
-                # 3. Transformer blocks
-                for i, block in enumerate(self.transformer_blocks):
-                    hidden_states, encoder_hidden_states = block(
-                        hidden_states=hidden_states[:1],
-                        encoder_hidden_states=encoder_hidden_states[:1],
-                        temb=emb[:1],
-                        image_rotary_emb=image_rotary_emb,
-                        video_flow_feature=video_flow_features[i][:1] if video_flow_features is not None else None,
-                        fuser = self.fuser_list[i] if self.fuser_list is not None else None,
-                        block_use_fastercache = i <= self.fastercache_num_blocks_to_cache,
-                        fastercache_counter = self.fastercache_counter,
-                        fastercache_start_step = self.fastercache_start_step,
-                        fastercache_device = self.fastercache_device
-                    )
+        fastercache_reuse = self.fastercache_counter >= self.fastercache_start_step + 3 and self.fastercache_counter % 5 != 0
+        if fastercache_reuse:
+            # only the first row is computed, the other one is recovered from the cached frequency delta
+            hidden_states = hidden_states[:1]
+            encoder_hidden_states = encoder_hidden_states[:1]
+            emb = emb[:1]
+        num_rows = hidden_states.shape[0]
 
-                    if (controlnet_states is not None) and (i < len(controlnet_states)):
-                        controlnet_states_block = controlnet_states[i]
-                        controlnet_block_weight = 1.0
-                        if isinstance(controlnet_weights, (list, np.ndarray)) or torch.is_tensor(controlnet_weights):
-                            controlnet_block_weight = controlnet_weights[i]
-                        elif isinstance(controlnet_weights, (float, int)):
-                            controlnet_block_weight = controlnet_weights
-                        
-                        hidden_states = hidden_states + controlnet_states_block * controlnet_block_weight
-                self.previous_residual = hidden_states - ori_hidden_states
-                self.previous_residual_encoder = encoder_hidden_states - ori_encoder_hidden_states
-                    
-            if not self.config.use_rotary_positional_embeddings:
-                # CogVideoX-2B
-                hidden_states = self.norm_final(hidden_states)
+        # cond and uncond rows keep separate distances and residuals
+        in_window = getattr(self, 'teacache_start_percent', 0.0) <= current_percent <= getattr(self, 'teacache_end_percent', 1.0)
+        calc_rows = []
+        rel_changes = []
+        for row in range(num_rows):
+            state = self.teacache_state.setdefault(row, {
+                'accumulated_rel_l1_distance': 0,
+                'previous_modulated_input': None,
+                'previous_residual': None,
+                'previous_residual_encoder': None,
+            })
+            modulated_input = emb[row:row+1]
+            if not in_window or state['previous_modulated_input'] is None or state['previous_residual'] is None:
+                should_calc = True
             else:
-                # CogVideoX-5B
-                hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
-                hidden_states = self.norm_final(hidden_states)
-                hidden_states = hidden_states[:, text_seq_length:]
+                rel_change = poly1d(coefficients, ((modulated_input-state['previous_modulated_input']).abs().mean() / state['previous_modulated_input'].abs().mean()))
+                rel_changes.append(rel_change.item())
+                state['accumulated_rel_l1_distance'] += rel_change
+                should_calc = state['accumulated_rel_l1_distance'] >= self.rel_l1_thresh
+            if should_calc:
+                state['accumulated_rel_l1_distance'] = 0
+                calc_rows.append(row)
+            state['previous_modulated_input'] = modulated_input
 
-            # 4. Final block
-            hidden_states = self.norm_out(hidden_states, temb=emb[:1])
-            hidden_states = self.proj_out(hidden_states)
+        # the FasterCache attention cache, controlnet and Tora features are batched over all rows
+        if calc_rows and (self.use_fastercache or controlnet_states is not None or video_flow_features is not None):
+            calc_rows = list(range(num_rows))
 
-            # 5. Unpatchify
-            # Note: we use `-1` instead of `channels`:
-            #   - It is okay to `channels` use for CogVideoX-2b and CogVideoX-5b (number of input channels is equal to output channels)
-            #   - However, for CogVideoX-5b-I2V also takes concatenated input image latents (number of input channels is twice the output channels)
-            
-            if p_t is None:
-                output = hidden_states.reshape(1, num_frames, height // p, width // p, -1, p, p)
-                output = output.permute(0, 1, 4, 2, 5, 3, 6).flatten(5, 6).flatten(3, 4)
-            else:
-                output = hidden_states.reshape(
-                    1, (num_frames + p_t - 1) // p_t, height // p, width // p, -1, p_t, p, p
+        # a large change also refreshes the cached enhance a video scores
+        begin_enhance_step(timestep, max(rel_changes) if rel_changes else None, scheduler)
+
+        hidden_rows = list(hidden_states.split(1))
+        encoder_rows = list(encoder_hidden_states.split(1))
+        if calc_rows:
+            ori_hidden_states = hidden_states[calc_rows]
+            ori_encoder_hidden_states = encoder_hidden_states[calc_rows]
+            hidden_states = ori_hidden_states
+            encoder_hidden_states = ori_encoder_hidden_states
+            # 3. Transformer blocks
+            for i, block in enumerate(self.transformer_blocks):
+                if video_flow_features is not None:
+                    video_flow_feature = video_flow_features[i][:1] if fastercache_reuse else video_flow_features[i]
+                else:
+                    video_flow_feature = None
+                hidden_states, encoder_hidden_states = block(
+                    hidden_states=hidden_states,
+                    encoder_hidden_states=encoder_hidden_states,
+                    temb=emb[calc_rows],
+                    image_rotary_emb=image_rotary_emb,
+                    video_flow_feature=video_flow_feature,
+                    fuser = self.fuser_list[i] if self.fuser_list is not None else None,
+                    block_use_fastercache = i <= self.fastercache_num_blocks_to_cache,
+                    fastercache_counter = self.fastercache_counter,
+                    fastercache_start_step = self.fastercache_start_step,
+                    fastercache_device = self.fastercache_device
                 )
-                output = output.permute(0, 1, 5, 4, 2, 6, 3, 7).flatten(6, 7).flatten(4, 5).flatten(1, 2)
-            
-            (bb, tt, cc, hh, ww) = output.shape
-            cond = rearrange(output, "B T C H W -> (B T) C H W", B=bb, C=cc, T=tt, H=hh, W=ww)
-            lf_c, hf_c = fft(cond.float())
 
-            if self.fastercache_counter <= self.fastercache_lf_step:
-                self.delta_lf = self.delta_lf * 1.1
-            if self.fastercache_counter >= self.fastercache_hf_step:
-                self.delta_hf = self.delta_hf * 1.1
+                # controlnet
+                if (controlnet_states is not None) and (i < len(controlnet_states)):
+                    controlnet_states_block = controlnet_states[i]
+                    controlnet_block_weight = 1.0
+                    if isinstance(controlnet_weights, (list, np.ndarray)) or torch.is_tensor(controlnet_weights):
+                        controlnet_block_weight = controlnet_weights[i]
+                    elif isinstance(controlnet_weights, (float, int)):
+                        controlnet_block_weight = controlnet_weights
+                    hidden_states = hidden_states + controlnet_states_block * controlnet_block_weight
 
-            new_hf_uc = self.delta_hf + hf_c
-            new_lf_uc = self.delta_lf + lf_c
+            for j, row in enumerate(calc_rows):
+                state = self.teacache_state[row]
+                state['previous_residual'] = hidden_states[j:j+1] - ori_hidden_states[j:j+1]
+                state['previous_residual_encoder'] = encoder_hidden_states[j:j+1] - ori_encoder_hidden_states[j:j+1]
+                hidden_rows[row] = hidden_states[j:j+1]
+                encoder_rows[row] = encoder_hidden_states[j:j+1]
 
-            combine_uc = new_lf_uc + new_hf_uc
-            combined_fft = torch.fft.ifftshift(combine_uc)
-            recovered_uncond = torch.fft.ifft2(combined_fft).real
-            recovered_uncond = rearrange(recovered_uncond.to(output.dtype), "(B T) C H W -> B T C H W", B=bb, C=cc, T=tt, H=hh, W=ww)
-            output = torch.cat([output, recovered_uncond])
-        else:
-            if not should_calc:
-                hidden_states += self.previous_residual
-                encoder_hidden_states += self.previous_residual_encoder
-            else:
-                ori_hidden_states = hidden_states.clone()
-                ori_encoder_hidden_states = encoder_hidden_states.clone()
-                for i, block in enumerate(self.transformer_blocks):
-                    hidden_states, encoder_hidden_states = block(
-                        hidden_states=hidden_states,
-                        encoder_hidden_states=encoder_hidden_states,
-                        temb=emb,
-                        image_rotary_emb=image_rotary_emb,
-                        video_flow_feature=video_flow_features[i] if video_flow_features is not None else None,
-                        fuser = self.fuser_list[i] if self.fuser_list is not None else None,
-                        block_use_fastercache = i <= self.fastercache_num_blocks_to_cache,
-                        fastercache_counter = self.fastercache_counter,
-                        fastercache_start_step = self.fastercache_start_step,
-                        fastercache_device = self.fastercache_device
-                    )
-
-                    # controlnet
-                    if (controlnet_states is not None) and (i < len(controlnet_states)):
-                        controlnet_states_block = controlnet_states[i]
-                        controlnet_block_weight = 1.0
-                        if isinstance(controlnet_weights, (list, np.ndarray)) or torch.is_tensor(controlnet_weights):
-                            controlnet_block_weight = controlnet_weights[i]
-                        elif isinstance(controlnet_weights, (float, int)):
-                            controlnet_block_weight = controlnet_weights                    
-                        hidden_states = hidden_states + controlnet_states_block * controlnet_block_weight
-                self.previous_residual = hidden_states - ori_hidden_states
-                self.previous_residual_encoder = encoder_hidden_states - ori_encoder_hidden_states
-                    
-            if not self.config.use_rotary_positional_embeddings:
-                # CogVideoX-2B
-                hidden_states = self.norm_final(hidden_states)
-            else:
-                # CogVideoX-5B
-                hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
-                hidden_states = self.norm_final(hidden_states)
-                hidden_states = hidden_states[:, text_seq_length:]
+        for row in range(num_rows):
+            if row not in calc_rows:
+                state = self.teacache_state[row]
+                hidden_rows[row] = hidden_rows[row] + state['previous_residual']
+                encoder_rows[row] = encoder_rows[row] + state['previous_residual_encoder']
+        hidden_states = torch.cat(hidden_rows)
+        encoder_hidden_states = torch.cat(encoder_rows)
 
-            # 4. Final block
-            hidden_states = self.norm_out(hidden_states, temb=emb)
-            hidden_states = self.proj_out(hidden_states)
+        if not self.config.use_rotary_positional_embeddings:
+            # CogVideoX-2B
+            hidden_states = self.norm_final(hidden_states)
+        else:
+            # CogVideoX-5B
+            hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
+            hidden_states = self.norm_final(hidden_states)
+            hidden_states = hidden_states[:, text_seq_length:]
 
-            # 5. Unpatchify
-            # Note: we use `-1` instead of `channels`:
-            #   - It is okay to `channels` use for CogVideoX-2b and CogVideoX-5b (number of input channels is equal to output channels)
-            #   - However, for CogVideoX-5b-I2V also takes concatenated input image latents (number of input channels is twice the output channels)
-            
-            if p_t is None:
-                output = hidden_states.reshape(batch_size, num_frames, height // p, width // p, -1, p, p)
-                output = output.permute(0, 1, 4, 2, 5, 3, 6).flatten(5, 6).flatten(3, 4)
-            else:
-                output = hidden_states.reshape(
-                    batch_size, (num_frames + p_t - 1) // p_t, height // p, width // p, -1, p_t, p, p
-                )
-                output = output.permute(0, 1, 5, 4, 2, 6, 3, 7).flatten(6, 7).flatten(4, 5).flatten(1, 2)
+        # 4. Final block
+        hidden_states = self.norm_out(hidden_states, temb=emb)
+        hidden_states = self.proj_out(hidden_states)
 
-            if self.fastercache_counter >= self.fastercache_start_step + 1: 
-                (bb, tt, cc, hh, ww) = output.shape
-                cond = rearrange(output[0:1].float(), "B T C H W -> (B T) C H W", B=bb//2, C=cc, T=tt, H=hh, W=ww)
-                uncond = rearrange(output[1:2].float(), "B T C H W -> (B T) C H W", B=bb//2, C=cc, T=tt, H=hh, W=ww)
+        # 5. Unpatchify
+        # Note: we use `-1` instead of `channels`:
+        #   - It is okay to `channels` use for CogVideoX-2b and CogVideoX-5b (number of input channels is equal to output channels)
+        #   - However, for CogVideoX-5b-I2V also takes concatenated input image latents (number of input channels is twice the output channels)
 
-                lf_c, hf_c = fft(cond)
-                lf_uc, hf_uc = fft(uncond)
+        if p_t is None:
+            output = hidden_states.reshape(num_rows, num_frames, height // p, width // p, -1, p, p)
+            output = output.permute(0, 1, 4, 2, 5, 3, 6).flatten(5, 6).flatten(3, 4)
+        else:
+            output = hidden_states.reshape(
+                num_rows, (num_frames + p_t - 1) // p_t, height // p, width // p, -1, p_t, p, p
+            )
+            output = output.permute(0, 1, 5, 4, 2, 6, 3, 7).flatten(6, 7).flatten(4, 5).flatten(1, 2)
 
-                self.delta_lf = lf_uc - lf_c
-                self.delta_hf = hf_uc - hf_c
+        if fastercache_reuse:
+            # the transformer comes from the CogVideoXWrapper loader, not from the vendored __init__, so
+            # nothing initializes fastercache_freq_delta. It is written below on every full step from
+            # fastercache_start_step + 1 on, and reuse only starts at fastercache_start_step + 3, so it
+            # is always set by then
+            if self.fastercache_freq_delta is not None:
+                recovered_uncond = self.fastercache_freq_delta.reconstruct(
+                    output,
+                    boost_lf=self.fastercache_counter <= self.fastercache_lf_step,
+                    boost_hf=self.fastercache_counter >= self.fastercache_hf_step,
+                )
+            else:
+                recovered_uncond = output
+            output = torch.cat([output, recovered_uncond])
+        elif self.fastercache_counter >= self.fastercache_start_step + 1:
+            self.fastercache_freq_delta = FrequencyDelta(output[0:1], output[1:2])
 
+        end_enhance_step()
         if not return_dict:
             return (output,)
         return Transformer2DModelOutput(sample=output)
@@ -267,7 +231,18 @@ class TeaCacheForCogVideoX:
             "required": {
                 "model": ("COGVIDEOMODEL", {"tooltip": "The CogVideoX model the TeaCache will be applied to."}),
                 "enable_teacache": ("BOOLEAN", {"default": True, "tooltip": "Enable teacache will speed up inference but may lose visual quality."}),
-                "rel_l1_thresh": ("FLOAT", {"default": 0.3, "min": 0.0, "max": 10.0, "step": 0.01, "tooltip": "How strongly to cache the output of diffusion model. This value must be non-negative."})
+                "rel_l1_thresh": ("FLOAT", {"default": 0.3, "min": 0.0, "max": 10.0, "step": 0.01, "tooltip": "How strongly to cache the output of diffusion model. This value must be non-negative."}),
+                "start_percent": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The start percentage of the steps that will apply TeaCache."}),
+                "end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The end percentage of the steps that will apply TeaCache."}),
+            },
+            "optional": {
+                "attention_mode": (["unchanged", "auto"], {"default": "unchanged", "tooltip": "auto benchmarks the available attention backends on the first use of every attention shape and keeps using the fastest one. The results are saved in the ComfyUI user directory."}),
+                "fuse_qkv": ("BOOLEAN", {"default": False, "tooltip": "Fuse the q/k/v projections of every attention into a single linear layer. Only applied with enable_teacache. The separate weights are dropped, so this stays applied until the model is reloaded."}),
+                "feta_refresh_interval": ("INT", {"default": 1, "min": 1, "max": 100, "step": 1, "tooltip": "Recompute the Enhance-A-Video scores every N steps and reuse them in between. 1 recomputes every step."}),
+                "feta_refresh_thresh": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 10.0, "step": 0.01, "tooltip": "Also recompute the Enhance-A-Video scores when the TeaCache relative change of a step exceeds this value. 0 disables."}),
+                "feta_workspace_mb": ("FLOAT", {"default": 256.0, "min": 1.0, "max": 65536.0, "step": 1.0, "tooltip": "Memory budget of the Enhance-A-Video score computation. The spatial tokens are processed in chunks that fit in it."}),
+                "feta_report": ("BOOLEAN", {"default": False, "tooltip": "Time the Enhance-A-Video score computation and print the computed/reused scores at the end of every run. Timing synchronizes the GPU."}),
+                "feta_num_samples": ("INT", {"default": 0, "min": 0, "max": 1000000, "step": 64, "tooltip": "Estimate the Enhance-A-Video scores from a fixed random subset of this many spatial tokens. 0 uses every token."}),
             }
         }
     
@@ -277,10 +252,38 @@ class TeaCacheForCogVideoX:
     CATEGORY = "TeaCache"
     TITLE = "TeaCache For CogVideoX"
     
-    def apply_teacache(self, model, enable_teacache: bool, rel_l1_thresh: float):
+    def apply_teacache(self, model, enable_teacache: bool, rel_l1_thresh: float, start_percent: float = 0.0, end_percent: float = 1.0, fuse_qkv: bool = False, attention_mode: str = "unchanged", feta_refresh_interval: int = 1, feta_refresh_thresh: float = 0.0, feta_workspace_mb: float = 256.0, feta_num_samples: int = 0, feta_report: bool = False):
+        set_enhance_refresh(feta_refresh_interval, feta_refresh_thresh)
+        set_enhance_workspace(feta_workspace_mb)
+        set_enhance_num_samples(feta_num_samples)
+        set_enhance_report(feta_report)
+        # the loaded model runs the wrapper's attention processors, the feta and attention options
+        # below only reach it through the processors of this repo
+        if install_attention_processors(model["pipe"].transformer) == 0:
+            print("[TeaCache] No CogVideoX self attentions found, the feta, fuse_qkv and attention_mode options have no effect on this model.")
+        patch_embed = getattr(model["pipe"].transformer, "patch_embed", None)
+        if patch_embed is not None:
+            cache_positional_embeddings(patch_embed)
+        # the timesteps of the pipe's scheduler give the step index of the current run
+        set_teacache_pipe(model["pipe"].transformer, model["pipe"])
+        # fusing can't be undone, so don't apply it to a model that is only meant to run unpatched
+        if fuse_qkv and enable_teacache:
+            fused = fuse_qkv_projections(model["pipe"].transformer)
+            if fused:
+                print(f"[TeaCache] Fused the q/k/v projections of {fused} attention layers.")
+            elif not any(hasattr(module, "to_qkv") for module in model["pipe"].transformer.modules()):
+                # nothing fused now or by an earlier run of the node
+                print("[TeaCache] fuse_qkv: no attention layer could be fused, quantized, LoRA patched or non-float projections are left as they are.")
+        if attention_mode != "unchanged" and set_attention_mode(model["pipe"].transformer, attention_mode) == 0:
+            print(f"[TeaCache] attention_mode {attention_mode}: no attention processor of this model could be switched.")
         if enable_teacache:
             transformer = model["pipe"].transformer
             transformer.rel_l1_thresh = rel_l1_thresh # Set as instance attribute
+            transformer.teacache_start_percent = start_percent
+            transformer.teacache_end_percent = end_percent
+            # drop the state of a previous run
+            transformer.__dict__.pop("teacache_state", None)
+            transformer.__dict__.pop("teacache_last_timestep", None)
             transformer.forward = teacache_cogvideox_forward.__get__(
                                 transformer,
                                 transformer.__class__
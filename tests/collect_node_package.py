@@ -0,0 +1,15 @@
+"""
+pytest plugin (see pyproject.toml). The repository root is the ComfyUI custom node package, its
+__init__ imports the nodes and so ComfyUI and torch. Collect the root as a plain directory so the
+tests that do not need ComfyUI run without it.
+"""
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def pytest_collect_directory(path, parent):
+    if path == ROOT:
+        return pytest.Dir.from_parent(parent, path=path)
@@ -0,0 +1,201 @@
+import importlib
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture(scope="module")
+def repo():
+    # the vendored CogVideoX model imports ComfyUI and uses relative imports up to the node package
+    for name in ("torch", "diffusers", "comfy", "folder_paths"):
+        pytest.importorskip(name)
+    sys.path.insert(0, str(ROOT.parent))
+    package = ROOT.name
+    return types.SimpleNamespace(
+        transformer_3d=importlib.import_module(f"{package}.models.cogvideox.custom_cogvideox_transformer_3d"),
+        globals=importlib.import_module(f"{package}.models.cogvideox.enhance_a_video.globals"),
+    )
+
+
+class ForeignProcessor:
+    """Processor of a model built by another package (the CogVideoXWrapper loader)."""
+    attention_mode = "sdpa"
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states, attention_mask=None, image_rotary_emb=None):
+        raise AssertionError("the foreign processor should have been replaced")
+
+
+def build_foreign_transformer(num_layers=2, heads=2, head_dim=8):
+    """A transformer the vendored CogVideoXTransformer3DModel constructor did not build."""
+    import torch
+    from diffusers.models.attention import Attention
+
+    transformer = torch.nn.Module()
+    transformer.transformer_blocks = torch.nn.ModuleList()
+    for _ in range(num_layers):
+        block = torch.nn.Module()
+        block.attn1 = Attention(
+            query_dim=heads * head_dim,
+            dim_head=head_dim,
+            heads=heads,
+            qk_norm="layer_norm",
+            eps=1e-6,
+            bias=True,
+            out_bias=True,
+            processor=ForeignProcessor(),
+        )
+        transformer.transformer_blocks.append(block)
+    return transformer
+
+
+def run_step(repo, transformer, timestep, num_frames=2, spatial=4, text=3):
+    import torch
+
+    dim = transformer.transformer_blocks[0].attn1.query_dim
+    repo.globals.bind_enhance_context(transformer, num_frames)
+    repo.globals.begin_enhance_step(timestep)
+    for block in transformer.transformer_blocks:
+        block.attn1(
+            hidden_states=torch.randn(1, num_frames * spatial, dim),
+            encoder_hidden_states=torch.randn(1, text, dim),
+        )
+
+
+def test_install_replaces_foreign_processors(repo):
+    transformer = build_foreign_transformer()
+
+    assert repo.transformer_3d.install_attention_processors(transformer) == 2
+    for i, block in enumerate(transformer.transformer_blocks):
+        processor = block.attn1.processor
+        assert isinstance(processor, repo.transformer_3d.CogVideoXAttnProcessor2_0)
+        assert processor.layer_idx == i
+        assert processor.attention_mode == "sdpa"
+
+
+def test_feta_score_cache_on_foreign_transformer(repo):
+    transformer = build_foreign_transformer()
+    repo.transformer_3d.install_attention_processors(transformer)
+    repo.globals.enable_enhance()
+    repo.globals.set_enhance_weight(1.0)
+    repo.globals.set_enhance_refresh(2)
+    try:
+        for step in range(3):
+            run_step(repo, transformer, 999 - step * 100)
+    finally:
+        repo.globals.disable_enhance()
+        repo.globals.set_enhance_refresh(1)
+
+    # refresh_interval 2 over 3 steps: computed on steps 0 and 2, reused on step 1
+    score_cache = transformer.enhance_score_cache
+    assert score_cache["computed"] == 2 * len(transformer.transformer_blocks)
+    assert score_cache["reused"] == len(transformer.transformer_blocks)
+
+
+def test_feta_workspace_and_samples_reach_foreign_transformer(repo, monkeypatch):
+    import torch
+
+    enhance = importlib.import_module(f"{ROOT.name}.models.cogvideox.enhance_a_video.enhance")
+    transformer = build_foreign_transformer(num_layers=1)
+    repo.transformer_3d.install_attention_processors(transformer)
+
+    sample_requests, scores = [], []
+    get_sample_indices, feta_score = enhance.get_sample_indices, enhance.feta_score
+
+    def record_sample_indices(num_tokens, num_samples, device):
+        sample_requests.append(num_samples)
+        return get_sample_indices(num_tokens, num_samples, device)
+
+    def record_feta_score(*args):
+        scores.append(feta_score(*args))
+        return scores[-1]
+
+    monkeypatch.setattr(enhance, "get_sample_indices", record_sample_indices)
+    monkeypatch.setattr(enhance, "feta_score", record_feta_score)
+    repo.globals.enable_enhance()
+    repo.globals.set_enhance_weight(1.0)
+    try:
+        repo.globals.set_enhance_num_samples(3)
+        run_step(repo, transformer, 999)
+        assert sample_requests[-1] == 3
+
+        # chunking the spatial tokens by the workspace does not change the scores
+        repo.globals.set_enhance_num_samples(0)
+        torch.manual_seed(0)
+        run_step(repo, transformer, 999)
+        repo.globals.set_enhance_workspace(1e-6)
+        torch.manual_seed(0)
+        run_step(repo, transformer, 999)
+        assert torch.allclose(scores[-2], scores[-1])
+    finally:
+        repo.globals.disable_enhance()
+        repo.globals.set_enhance_num_samples(0)
+        repo.globals.set_enhance_workspace(256)
+
+
+def test_concurrent_pipelines_on_foreign_transformers(repo):
+    import threading
+
+    frames = {"a": 2, "b": 3}
+    transformers = {name: build_foreign_transformer() for name in frames}
+    for transformer in transformers.values():
+        repo.transformer_3d.install_attention_processors(transformer)
+        # the wrapper's enhance globals are shared by every thread, only the settings are read from them
+        transformer.enhance_globals = types.SimpleNamespace(is_enhance_enabled=lambda: True, get_enhance_weight=lambda: 1.0)
+    barrier = threading.Barrier(len(frames))
+    seen_frames, errors = {}, []
+
+    def pipeline(name):
+        try:
+            repo.globals.set_enhance_refresh(2)
+            for step in range(3):
+                barrier.wait()
+                run_step(repo, transformers[name], 999 - step * 100, num_frames=frames[name])
+                seen_frames.setdefault(name, []).append(repo.globals.get_num_frames())
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=pipeline, args=(name,)) for name in frames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    for name, transformer in transformers.items():
+        assert seen_frames[name] == [frames[name]] * 3
+        assert transformer.enhance_score_cache["computed"] == 2 * len(transformer.transformer_blocks)
+        assert transformer.enhance_score_cache["reused"] == len(transformer.transformer_blocks)
+
+
+def test_scheduler_is_read_from_the_pipe_at_call_time(repo):
+    class Pipe:
+        scheduler = "default"
+
+    transformer = build_foreign_transformer(num_layers=1)
+    pipe = Pipe()
+    repo.transformer_3d.set_teacache_pipe(transformer, pipe)
+
+    # the sampler replaces the scheduler after the node was applied
+    pipe.scheduler = "sampler"
+    assert repo.transformer_3d.get_teacache_scheduler(transformer) == "sampler"
+
+
+def test_fuse_qkv_on_foreign_transformer(repo):
+    transformer = build_foreign_transformer()
+    # the wrapper's processors do not read to_qkv, nothing is fused until the repo's are installed
+    assert repo.transformer_3d.fuse_qkv_projections(transformer) == 0
+    repo.transformer_3d.install_attention_processors(transformer)
+    assert repo.transformer_3d.fuse_qkv_projections(transformer) == 2
+    assert all(hasattr(block.attn1, "to_qkv") for block in transformer.transformer_blocks)
+
+
+def test_attention_mode_on_foreign_transformer(repo):
+    transformer = build_foreign_transformer()
+    repo.transformer_3d.install_attention_processors(transformer)
+    assert repo.transformer_3d.set_attention_mode(transformer, "auto") == 2
+    assert all(block.attn1.processor.attention_mode == "auto" for block in transformer.transformer_blocks)
@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def test_positional_embeddings_of_a_foreign_patch_embed_are_cached():
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("diffusers")
+    from models.cogvideox.embeddings import cache_positional_embeddings
+
+    class ForeignPatchEmbed(torch.nn.Module):
+        """Patch embedding of a model built by another package."""
+        use_positional_embeddings = True
+
+        def __init__(self):
+            super().__init__()
+            self.builds = 0
+
+        def _get_positional_embeddings(self, height, width, frames):
+            self.builds += 1
+            return torch.randn(1, frames * height * width, 4)
+
+    patch_embed = ForeignPatchEmbed()
+    assert cache_positional_embeddings(patch_embed)
+    first = patch_embed._get_positional_embeddings(4, 6, 13)
+    assert patch_embed._get_positional_embeddings(4, 6, 13) is first
+    patch_embed._get_positional_embeddings(8, 6, 13)
+    assert patch_embed.builds == 2
+    assert patch_embed.pos_embedding_cache.stats()["hits"] == 1
@@ -0,0 +1,106 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from models.cogvideox.enhance_a_video import globals as enhance_globals
+
+
+class ToyTransformer:
+    """Stands in for a CogVideoX transformer: binds the context and runs a toy attention per layer."""
+
+    def __init__(self, num_layers=2):
+        self.num_layers = num_layers
+
+    def forward(self, num_frames, timestep, score_fn):
+        enhance_globals.bind_enhance_context(self, num_frames)
+        enhance_globals.begin_enhance_step(timestep)
+        for layer_idx in range(self.num_layers):
+            scores = enhance_globals.get_cached_feta_scores(layer_idx)
+            if scores is None:
+                enhance_globals.store_feta_scores(layer_idx, score_fn(enhance_globals.get_num_frames(), layer_idx), 0.0)
+
+
+def run_pipelines(score_fn, steps=5):
+    frames = {"a": 13, "b": 49}
+    transformers = {name: ToyTransformer() for name in frames}
+    barrier = threading.Barrier(len(frames))
+    results, errors = {}, []
+
+    def pipeline(name):
+        try:
+            enhance_globals.enable_enhance()
+            enhance_globals.set_enhance_weight(1.0)
+            enhance_globals.set_enhance_refresh(2)
+            seen_frames = []
+            for step in range(steps):
+                # both threads are inside the same step before either runs its layers
+                barrier.wait()
+                transformers[name].forward(frames[name], 999 - step * 100, score_fn)
+                seen_frames.append(enhance_globals.get_num_frames())
+            context = enhance_globals.get_enhance_context()
+            results[name] = (seen_frames, context.score_cache)
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=pipeline, args=(name,)) for name in frames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    return frames, transformers, results
+
+
+def test_concurrent_pipelines_keep_their_own_context():
+    frames, transformers, results = run_pipelines(lambda num_frames, layer_idx: (num_frames, layer_idx))
+
+    for name, (seen_frames, score_cache) in results.items():
+        assert seen_frames == [frames[name]] * len(seen_frames)
+        # the score cache is the one of the transformer the thread ran
+        assert score_cache is transformers[name].enhance_score_cache
+        assert all(scores[0] == frames[name] for scores in score_cache["scores"].values())
+        # refresh_interval 2 over 5 steps: computed on steps 0, 2, 4
+        assert score_cache["computed"] == 3 * transformers[name].num_layers
+        assert score_cache["reused"] == 2 * transformers[name].num_layers
+    assert results["a"][1] is not results["b"][1]
+
+
+def test_unbound_threads_do_not_share_a_score_cache():
+    caches = []
+
+    def worker():
+        caches.append(enhance_globals.get_enhance_context().score_cache)
+
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert caches[0] is not caches[1]
+
+
+def test_concurrent_feta_scores_on_toy_attention():
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("diffusers")
+    from models.cogvideox.enhance_a_video.enhance import get_feta_scores
+
+    heads, head_dim, spatial = 2, 8, 6
+
+    def toy_scores(num_frames, layer_idx):
+        generator = torch.Generator().manual_seed(layer_idx)
+        query = torch.randn(1, heads, num_frames * spatial, head_dim, generator=generator)
+        key = torch.randn(1, heads, num_frames * spatial, head_dim, generator=generator)
+        return get_feta_scores(None, query, key, head_dim, 0)
+
+    frames, transformers, results = run_pipelines(toy_scores)
+    for name, (_, score_cache) in results.items():
+        for layer_idx, scores in score_cache["scores"].items():
+            # recomputing single threaded gives the same score, so no thread used the other's num_frames
+            enhance_globals.set_enhance_weight(1.0)
+            enhance_globals.bind_enhance_context(ToyTransformer(), frames[name])
+            assert torch.allclose(scores, toy_scores(frames[name], layer_idx))